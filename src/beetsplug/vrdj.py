@@ -16,40 +16,127 @@ class VrdjPlugin(BeetsPlugin):
             'auto':False,
             'device':'cpu',
             'embedding':'vggish',
-            'metric':'cosine'})
+            'metric':'cosine',
+            'workers':0,
+            'batch_size':32,
+            'checkpoint':1024,
+            'mode':'average',
+            'aggregate':'max',
+            'index':'flat',
+            'index_options':{},
+            'reduce':'',
+            'codec':'f32',
+            'cache_size':1024,
+            'window':50,
+            'artist_gap':3,
+            'drift':0.1,
+            'diversity':0.0,
+            'compile':'',
+            'threads':0,
+            'server':True,
+            'socket':'',
+            'filter':''})
         if self.config['auto'].get(bool):
             self.register_listener('item_imported', self.vrdj_ingest_item)
             self.register_listener('album_imported', self.vrdj_ingest_album)
+        self.register_listener('cli_exit', self.vrdj_close)
+
+    @property
+    def vrdj_directory(self):
+        directory = self.config['directory'].get()
+        if not directory:
+            library_file_path = main_config['library'].as_filename()
+            return Path(library_file_path).parent / "vrdj"
+        return Path(directory)
+
+    @property
+    def vrdj_client(self):
+        '''
+        A client of a running "vrdj serve" or None.
+        '''
+        if not self.config['server'].get(bool):
+            return None
+        from vrdj.client import connect
+        path = self.config['socket'].get() or self.vrdj_directory / 'vrdj.sock'
+        return connect(path)
 
     @property
     def vrdj_store(self):
         if not hasattr(self, '_vrdj_store'):
             from vrdj import db
-            directory = self.config['directory'].get()
-            if not directory:
-                library_file_path = main_config['library'].as_filename()
-                directory = Path(library_file_path).parent / "vrdj"
-            else:
-                directory = Path(directory)
+            directory = self.vrdj_directory
             embedding = self.config['embedding'].get()
             metric = self.config['metric'].get()
             device = self.config['device'].get()
             # print(f'vrdj: {embedding=} {metric=} {device=} {directory=}')
+            index_type = self.config['index'].get()
+            index_options = self.config['index_options'].get(dict)
             self._vrdj_store = db.Store(directory, metric=metric,
-                                        embedding=embedding, device=device)
+                                        embedding=embedding, device=device,
+                                        index_type=index_type,
+                                        index_options=index_options,
+                                        reduce=self.config['reduce'].get() or None,
+                                        codec=self.config['codec'].get(),
+                                        cache_size=self.config['cache_size'].get(int),
+                                        model_options=self.vrdj_model_options)
         return self._vrdj_store
             
 
+    def vrdj_close(self, lib=None):
+        '''
+        Flush and close the store if it was opened.
+        '''
+        store = self.__dict__.pop('_vrdj_store', None)
+        if store is not None:
+            store.close()
+
+    @property
+    def vrdj_model_options(self):
+        options = dict()
+        if self.config['compile'].get():
+            options['compile'] = self.config['compile'].get()
+        if self.config['threads'].get(int):
+            options['threads'] = self.config['threads'].get(int)
+        return options
+
     def vrdj_ingest_album(self, lib, album):
-        for item in album.items():
-            self.vrdj_ingest_item(item)
+        self.vrdj_ingest_many(album.items())
+
+    def vrdj_ingest_many(self, items, force=False):
+        '''
+        Bulk ingest items, return the ingest stats.
+        '''
+        from vrdj.ingest import bulk_ingest
+        workers = self.config['workers'].get(int) or None
+        batch_size = self.config['batch_size'].get(int)
+        items = list(items)
+        pairs = [(item.id, item.path.decode()) for item in items]
+
+        def progress(stats):
+            self._log.info(f'ingesting: {stats}')
+
+        stats = bulk_ingest(self.vrdj_store, pairs, workers=workers,
+                            batch_size=batch_size, force=force,
+                            checkpoint=self.config['checkpoint'].get(int),
+                            progress=progress,
+                            groups={item.id: self.vrdj_groups(item) for item in items})
+        self._log.info(f'ingested: {stats}')
+        return stats
+
+    def vrdj_groups(self, item):
+        '''
+        Return the names of the album and artist of an item for the vrdj
+        centroid indices.
+        '''
+        return dict(album=str(item.album_id) if item.album_id else None,
+                    artist=item.artist or None)
 
     def vrdj_ingest_item(self, lib, item):
         store = self.vrdj_store
         item_path = item.path.decode()
         self._log.debug(f'ingesting {item.id} {item_path}')
         try:
-            store.add_embedding(item.id, item_path)
+            store.add_embedding(item.id, item_path, groups=self.vrdj_groups(item))
         except Exception as err:
             self._log.error(f'failed with {err}')
             self._log.error(f'is the file valid? {item_path}')
@@ -67,6 +154,47 @@ class VrdjPlugin(BeetsPlugin):
         vrdj_command.parser.add_option(
             '-n', '--number', default=10, type=int,
             help='Max number of similar items')
+        vrdj_command.parser.add_option(
+            '-m', '--mode', default=None,
+            choices=['average', 'segment', 'album', 'artist'],
+            help='Compare song average vectors or per-segment vectors, '
+            'or find albums or artists similar to those of the seeds')
+        vrdj_command.parser.add_option(
+            '-A', '--aggregate', default=None, choices=['max', 'mean', 'vote'],
+            help='How segment mode combines segment hits into a song score')
+        vrdj_command.parser.add_option(
+            '-s', '--stream', action='store_true', default=False,
+            help='Emit an endless radio stream of similar items until interrupted')
+        vrdj_command.parser.add_option(
+            '-F', '--filter', default=None, type=str,
+            help='Only find items matching this beets query')
+        vrdj_command.parser.add_option(
+            '--other-artists', action='store_true', default=False,
+            help='Only find items by artists other than those of the seeds')
+        vrdj_command.parser.add_option(
+            '-D', '--diversity', default=None, type=float,
+            help='Trade similarity for variety among the results, 0 to 1 (average mode)')
+        vrdj_command.parser.add_option(
+            '--drift', default=None, type=float,
+            help='How far the --stream moves toward each played item, 0 to 1')
+        vrdj_command.parser.add_option(
+            '--profile', action='store_true', default=False,
+            help='Print the time spent in each stage')
+        vrdj_command.parser.add_option(
+            '--profile-output', default=None, type=str,
+            help='Write the per-stage times as JSON to this file')
+        vrdj_command.parser.add_option(
+            '--no-cache', dest='cache', action='store_false', default=True,
+            help='Do not use or update the query result cache')
+        vrdj_command.parser.add_option(
+            '-i', '--ingest', action='store_true', default=False,
+            help='Bulk ingest the items matching the query instead of searching')
+        vrdj_command.parser.add_option(
+            '-j', '--workers', default=None, type=int,
+            help='Number of audio decode processes for --ingest')
+        vrdj_command.parser.add_option(
+            '-b', '--batch-size', default=None, type=int,
+            help='Number of items to embed and commit together for --ingest')
         vrdj_command.parser.add_all_common_options()
         vrdj_command.parser.usage += (
             "\nSimilarity indexing and queries"
@@ -75,51 +203,244 @@ class VrdjPlugin(BeetsPlugin):
         return [vrdj_command]
 
     def _vrdj_command_func(self, lib, opts, args):
+        if not (opts.profile or opts.profile_output):
+            return self._vrdj_command(lib, opts, args)
+        from vrdj import trace
+        trace.enable()
+        try:
+            return self._vrdj_command(lib, opts, args)
+        finally:
+            if opts.profile:
+                print_(trace.report())
+            if opts.profile_output:
+                trace.export(opts.profile_output)
 
-        from vrdj.op import similar_average_many
+    def _vrdj_command(self, lib, opts, args):
+
+        from vrdj.client import ServerError
 
         query = decargs(args)
         items = lib.items(query)
 
-        # ingest no matter what.  This is idempotent but we'll see if it is fast
-        # enough to keep
+        if opts.ingest:
+            if opts.workers is not None:
+                self.config['workers'].set(opts.workers)
+            if opts.batch_size is not None:
+                self.config['batch_size'].set(opts.batch_size)
+            self.vrdj_ingest_many(items, force=self.config['force'].get(bool))
+            return
+
+        # Check all seeds at once and only ingest, and so only load the
+        # embedding model, for those not yet in the store.  A running server
+        # is asked so the store is only opened here if it must be.
+        items = list(items)
+        have = None
+        client = self.vrdj_client
+        if client:
+            try:
+                have = client.stored([item.id for item in items])
+            except (OSError, ServerError) as err:
+                self._log.warning(f'vrdj server failed, searching here: {err}')
+                client = None
+        if have is None:
+            have = self.vrdj_store.stored_item_ids([item.id for item in items])
         item_ids = list()
         for item in items:
-            item = self.vrdj_ingest_item(lib, item)
-            if item is None:
-                continue
+            if item.id not in have:
+                item = self.vrdj_ingest_item(lib, item)
+                if item is None:
+                    continue
             item_ids.append(item.id)
         if not item_ids:
             self._log.error("no seed items")
             return
 
-        new_ids = similar_average_many(self.vrdj_store, item_ids, opts.number)
+        filter_query = self.config['filter'].get() if opts.filter is None else opts.filter
+        allowed = self._vrdj_allowed(lib, filter_query, item_ids, opts.other_artists)
+
+        if opts.stream:
+            from vrdj.op import radio
+            with lib.transaction() as tx:
+                artists = dict(tx.query('SELECT id, artist FROM items'))
+            drift = self.config['drift'].get(float) if opts.drift is None else opts.drift
+            stream = radio(self.vrdj_store, item_ids,
+                           window=self.config['window'].get(int),
+                           artist_of=artists.get,
+                           artist_gap=self.config['artist_gap'].get(int),
+                           drift=drift, allowed=allowed)
+            out = self._vrdj_playlist(opts.playlist)
+            try:
+                for item_id in stream:
+                    self._vrdj_emit(item_id, lib.get_item(item_id), out)
+            except KeyboardInterrupt:
+                pass
+            return
+
+        mode = opts.mode or self.config['mode'].get()
+        if mode in ('album', 'artist'):
+            seeds = [item for item in items if item.id in set(item_ids)]
+            self._vrdj_similar_groups(lib, mode, seeds, opts, allowed)
+            return
+
+        aggregate = opts.aggregate or self.config['aggregate'].get()
+        diversity = self.config['diversity'].get(float) \
+            if opts.diversity is None else opts.diversity
+        if diversity and mode != 'average':
+            self._log.warning(f'diversity is only used in average mode, not {mode}')
+            diversity = 0.0
+        new_ids = None
+        if client:
+            try:
+                new_ids = client.similar(item_ids, opts.number, mode=mode,
+                                         aggregate=aggregate, cache=opts.cache,
+                                         allowed=allowed, diversity=diversity)
+            except (OSError, ServerError) as err:
+                self._log.warning(f'vrdj server failed, searching here: {err}')
+        if new_ids is None:
+            from vrdj.op import similar_average_many, similar_segment_many
+            if mode == 'segment':
+                new_ids = similar_segment_many(self.vrdj_store, item_ids, opts.number,
+                                               aggregate=aggregate, cache=opts.cache,
+                                               allowed=allowed)
+            else:
+                new_ids = similar_average_many(self.vrdj_store, item_ids, opts.number,
+                                               cache=opts.cache, allowed=allowed,
+                                               diversity=diversity)
+            self._log.info(f'query cache: {self.vrdj_store.cache.stats()}')
         if not new_ids:
             self._log.error("no similar songs")
 
-        if opts.playlist:
-            out = open(opts.playlist, "w")
-            out.write("#EXTM3U\n")
-            for item_id in new_ids:
-                item = lib.get_item(item_id)
-                if item is None:
-                    self._log.error(f'no item for {item_id=}')
+        out = self._vrdj_playlist(opts.playlist)
+        found = self._vrdj_items(lib, new_ids)
+        for item_id in new_ids:
+            self._vrdj_emit(item_id, found.get(item_id), out)
+
+    def _vrdj_similar_groups(self, lib, kind, seeds, opts, allowed=None):
+        '''
+        Emit the albums or artists most similar to those of the seed items.
+        '''
+        from vrdj.op import similar_groups
+        from beets.dbcore.query import OrQuery, MatchQuery
+        store = self.vrdj_store
+        groups = {item.id: self.vrdj_groups(item) for item in seeds}
+        # Seeds stored before they had groups join them now, unless that
+        # would wait for another process which is writing.
+        store.add_groups(groups, wait=False)
+        names = [one[kind] for one in groups.values() if one[kind]]
+        if not names:
+            self._log.error(f'no {kind} for the seed items')
+            return
+        if allowed is not None:
+            with lib.transaction() as tx:
+                rows = tx.query('SELECT id, album_id, artist FROM items')
+            column = 1 if kind == 'album' else 2
+            allowed = set(str(row[column]) for row in rows
+                          if row[0] in allowed and row[column])
+        found = None
+        client = self.vrdj_client
+        if client:
+            from vrdj.client import ServerError
+            try:
+                found = client.similar_groups(kind, names, opts.number,
+                                              cache=opts.cache, allowed=allowed)
+            except (OSError, ServerError) as err:
+                self._log.warning(f'vrdj server failed, searching here: {err}')
+        if found is None:
+            found = similar_groups(store, kind, names, opts.number,
+                                   cache=opts.cache, allowed=allowed)
+        if not found:
+            self._log.error(f'no similar {kind}s')
+            return
+        out = self._vrdj_playlist(opts.playlist)
+        if kind == 'album':
+            albums = {album.id: album for album in
+                      lib.albums(OrQuery([MatchQuery('id', int(one)) for one in found]))}
+            for name in found:
+                album = albums.get(int(name))
+                if album is None:
+                    self._log.error(f'no album for album_id={name}')
                     continue
-                out.write(f"#EXTINF:{int(item.length)},{item.artist} - {item.title}\n")
-                out.write(item.path.decode() + "\n")
+                print_(format(album))
+                for item in album.items():
+                    self._vrdj_emit_playlist(item, out)
+            return
+        for name in found:
+            print_(name)
+            if out:
+                for item in lib.items(MatchQuery('artist', name)):
+                    self._vrdj_emit_playlist(item, out)
 
-        for item_id in new_ids:
-            #print(f'{item_id=} {type(item_id)}')
-            item = lib.get_item(item_id)
-            if item is None:
-                self._log.error(f'no item for {item_id=}')
-                continue
-            print_(format(item))
-            #print_(format(item, fmt))
-            # print(f'{item=}')
-
-        # if --ingest
-        # if --playlist
-        # else print
+    def _vrdj_allowed(self, lib, query, seed_ids, other_artists=False):
+        '''
+        Return the set of IDs of items matching the beets query and, if
+        other_artists, not by an artist of the seeds.  Return None if neither
+        restricts the items.
 
-            
+        A query only on item fields is run as one SQL query for the IDs
+        without making items, other queries are matched by beets.
+        '''
+        from beets.library import Item, parse_query_string
+        allowed = None
+        if query:
+            parsed, _ = parse_query_string(query, Item)
+            where, subvals = parsed.clause()
+            names = getattr(parsed, 'field_names', None)
+            if where is not None and names is not None and set(names) <= set(Item._fields):
+                with lib.transaction() as tx:
+                    rows = tx.query(f'SELECT id FROM items WHERE {where}', subvals)
+                allowed = set(row[0] for row in rows)
+            else:
+                allowed = set(item.id for item in lib.items(parsed))
+        if other_artists:
+            marks = ','.join('?' * len(seed_ids))
+            with lib.transaction() as tx:
+                rows = tx.query(
+                    f'SELECT id FROM items WHERE artist NOT IN '
+                    f'(SELECT artist FROM items WHERE id IN ({marks}))', seed_ids)
+            others = set(row[0] for row in rows)
+            allowed = others if allowed is None else allowed & others
+        if allowed is not None:
+            self._log.debug(f'searching {len(allowed)} allowed items')
+        return allowed
+
+    def _vrdj_items(self, lib, item_ids):
+        '''
+        Return a dict of the items of the item_ids fetched in bulk.
+        '''
+        from beets.dbcore.query import OrQuery, MatchQuery
+        found = dict()
+        item_ids = list(item_ids)
+        for first in range(0, len(item_ids), 500):
+            chunk = item_ids[first:first + 500]
+            query = OrQuery([MatchQuery('id', item_id) for item_id in chunk])
+            found.update((item.id, item) for item in lib.items(query))
+        return found
+
+    def _vrdj_playlist(self, path):
+        '''
+        Return an open m3u playlist file at path or None if no path.
+        '''
+        if not path:
+            return None
+        out = open(path, "w")
+        out.write("#EXTM3U\n")
+        return out
+
+    def _vrdj_emit(self, item_id, item, out=None):
+        '''
+        Print the item and append it to the out playlist if given.
+        '''
+        if item is None:
+            self._log.error(f'no item for {item_id=}')
+            return
+        self._vrdj_emit_playlist(item, out)
+        print_(format(item))
+
+    def _vrdj_emit_playlist(self, item, out=None):
+        '''
+        Append the item to the out playlist if given.
+        '''
+        if out:
+            out.write(f"#EXTINF:{int(item.length)},{item.artist} - {item.title}\n")
+            out.write(item.path.decode() + "\n")
+            out.flush()
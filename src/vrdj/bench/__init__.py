@@ -0,0 +1,5 @@
+'''
+vrdj benchmarks
+
+Each module of this package is runnable with "python -m vrdj.bench.<name>".
+'''
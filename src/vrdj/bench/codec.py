@@ -0,0 +1,89 @@
+'''
+Compare embedding codecs by size and similarity-ranking fidelity.
+
+For each codec, embeddings are encoded and decoded and their average vectors
+searched against each other.  Fidelity is the recall@k of the decoded ranking
+relative to the full precision float32 ranking.
+
+  python -m vrdj.bench.codec [--directory STORE] [--items N] [-k K]
+
+With --directory, embeddings are sampled from an existing store, otherwise
+synthetic embeddings are used.
+'''
+
+import sys
+import json
+import argparse
+import numpy
+import faiss
+
+from vrdj import codec as vcodec
+from vrdj.bench import synthetic
+
+
+def averages(embs):
+    '''
+    Return the cosine-normalized average vectors of embeddings.
+    '''
+    out = list()
+    for emb in embs:
+        emb = numpy.array(emb, dtype='float32')
+        faiss.normalize_L2(emb)
+        out.append(emb.mean(axis=0))
+    return numpy.vstack(out).astype('float32')
+
+
+def ranking(vectors, queries, k):
+    index = faiss.IndexFlatIP(vectors.shape[1])
+    index.add(vectors)
+    return index.search(queries, k)[1]
+
+
+def run(embs, k=10, nqueries=200, seed=0):
+    '''
+    Return a list of per-codec report dicts for the list of embeddings.
+    '''
+    rng = numpy.random.default_rng(seed)
+    qidx = rng.choice(len(embs), min(nqueries, len(embs)), replace=False)
+    base = averages(embs)
+    want = ranking(base, base[qidx], k)
+    nvalues = sum(emb.size for emb in embs)
+
+    reports = list()
+    for name in vcodec.codecs:
+        blobs = [vcodec.encode(emb, name) for emb in embs]
+        decoded = [vcodec.decode(blob) for blob in blobs]
+        vecs = averages(decoded)
+        got = ranking(vecs, vecs[qidx], k)
+        recall = numpy.mean([len(set(g) & set(w)) / k for g, w in zip(got, want)])
+        maxerr = max(float(numpy.abs(d - e).max()) for d, e in zip(decoded, embs))
+        nbytes = sum(len(blob) for blob in blobs)
+        reports.append(dict(codec=name, bytes_per_item=nbytes / len(embs),
+                            bytes_per_value=nbytes / nvalues,
+                            max_abs_error=maxerr, recall=float(recall), k=k))
+    return reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-d', '--directory', default=None,
+                        help='Sample embeddings from this vrdj store.')
+    parser.add_argument('-n', '--items', type=int, default=2000,
+                        help='Number of items to use.')
+    parser.add_argument('-k', type=int, default=10,
+                        help='Number of neighbours compared.')
+    args = parser.parse_args(argv)
+
+    if args.directory:
+        from vrdj import db
+        store = db.Store(args.directory)
+        embs = [emb for _, emb in zip(range(args.items), store.iter_embeddings())]
+    else:
+        embs = [emb for _, emb in synthetic.embeddings(args.items)]
+
+    print(json.dumps(run(embs, k=args.k), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+'''
+Guard the startup cost of the pure-query path.
+
+In a fresh interpreter this builds a small store from synthetic embeddings and
+runs a similarity query, as "beet vrdj" does when all seeds are already
+ingested.  It reports the time taken to import the query-path modules and
+fails if any module needed only to compute embeddings was imported.
+
+  python -m vrdj.bench.imports [--max-seconds S]
+'''
+
+import sys
+import json
+import argparse
+import subprocess
+
+# Modules which must not be imported when no embedding is computed.
+forbidden = ('torch', 'torchvggish', 'resampy', 'numba')
+
+probe = '''
+import sys, json, time, tempfile
+start = time.perf_counter()
+from vrdj import db, op
+imported = time.perf_counter() - start
+import numpy
+with tempfile.TemporaryDirectory() as tmp:
+    store = db.Store(tmp)
+    rng = numpy.random.default_rng(0)
+    store.add_many_embeddings(
+        (item_id, rng.random((10, store.vector_length), dtype='float32'))
+        for item_id in range(1, 101))
+    store.close()
+    store = db.Store(tmp)
+    start = time.perf_counter()
+    op.similar_average_many(store, [1, 2], 10)
+    queried = time.perf_counter() - start
+print(json.dumps(dict(import_seconds=imported, query_seconds=queried,
+                      modules=sorted(sys.modules))))
+'''
+
+
+def run():
+    '''
+    Run the probe and return its report as a dict.
+    '''
+    got = subprocess.run([sys.executable, '-c', probe], check=True,
+                         capture_output=True, text=True)
+    report = json.loads(got.stdout.splitlines()[-1])
+    modules = report.pop('modules')
+    report['forbidden'] = sorted(name for name in modules
+                                 if name.split('.')[0] in forbidden)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--max-seconds', type=float, default=None,
+                        help='Fail if importing the query path takes longer.')
+    args = parser.parse_args(argv)
+
+    report = run()
+    print(json.dumps(report, indent=2))
+    failed = False
+    if report['forbidden']:
+        print(f'FAIL: query path imported {", ".join(report["forbidden"])}')
+        failed = True
+    if args.max_seconds is not None and report['import_seconds'] > args.max_seconds:
+        print(f'FAIL: query path import took {report["import_seconds"]:.3f}s '
+              f'> {args.max_seconds}s')
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+'''
+Compare ways to take the per-item means of stacked segment vectors.
+
+Index.vectorize_many() stacks the segments of many items in one array and
+needs the mean of each item's rows.  Each method is timed on synthetic float32
+vectors for several item counts and segments per item.
+
+  python -m vrdj.bench.means [--dim D] [--repeat R]
+
+- views :: numpy.mean() of each item's slice, as vectorize_many() does.
+- reduceat :: numpy.add.reduceat() over the rows divided by the counts.
+- cumsum :: differences of a float64 cumulative sum at the item boundaries.
+'''
+
+import sys
+import json
+import time
+import argparse
+import numpy
+
+
+def views(vecs, starts, sizes):
+    return numpy.vstack([numpy.mean(vecs[start:start + size], axis=0)
+                         for start, size in zip(starts.tolist(), sizes.tolist())])
+
+
+def reduceat(vecs, starts, sizes):
+    return numpy.add.reduceat(vecs, starts, axis=0) / sizes[:, None]
+
+
+def cumsum(vecs, starts, sizes):
+    total = numpy.zeros((len(vecs) + 1, vecs.shape[1]), dtype='float64')
+    numpy.cumsum(vecs, axis=0, out=total[1:])
+    return (total[starts + sizes] - total[starts]) / sizes[:, None]
+
+
+methods = dict(views=views, reduceat=reduceat, cumsum=cumsum)
+
+# (items, fewest, most segments per item)
+shapes = [(10000, 1, 40), (1000, 20, 400), (200, 100, 3000)]
+
+
+def run(dim=128, repeat=5, seed=0):
+    '''
+    Return a list of report dicts, one per shape and method.
+    '''
+    rng = numpy.random.default_rng(seed)
+    reports = list()
+    for nitems, lo, hi in shapes:
+        sizes = rng.integers(lo, hi, nitems)
+        starts = numpy.cumsum(sizes) - sizes
+        vecs = rng.random((int(sizes.sum()), dim), dtype='float32')
+        want = views(vecs, starts, sizes)
+        for name, func in methods.items():
+            func(vecs, starts, sizes)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                got = func(vecs, starts, sizes)
+            ms = 1000 * (time.perf_counter() - start) / repeat
+            reports.append(dict(method=name, items=nitems, rows=len(vecs),
+                                ms=ms, max_abs_error=float(numpy.abs(got - want).max())))
+    return reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--dim', type=int, default=128,
+                        help='Vector length.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of timed calls of each method.')
+    args = parser.parse_args(argv)
+    json.dump(run(args.dim, args.repeat), sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+'''
+Stress a store with concurrent writers and readers in separate processes.
+
+  python -m vrdj.bench.stress [--writers W] [--readers R] [--items N]
+                              [--batch B] [--segments S] [--output FILE]
+
+Each writer ingests its own N synthetic items.  Even-numbered writers add
+batches of B items with Store.add_many_embeddings() as a bulk ingest does.
+Odd-numbered writers add one item at a time with Store.add_embedding() as
+"beet import" does with "auto: yes".  Meanwhile each reader runs similarity
+queries, with the query cache on, in a store it opened once.
+
+Afterwards the store is checked: every item must be stored, each index must
+hold exactly the vectors of all items, and every vector ID must map to the
+item whose vector it holds.  Any error seen by a process, such as "database
+is locked", or a failed check makes the exit status non-zero.
+
+The output is a JSON report of write and query throughput, query latency
+percentiles and the check results.
+'''
+
+import sys
+import json
+import time
+import argparse
+import tempfile
+import multiprocessing
+
+import numpy
+
+from vrdj.bench import synthetic
+from vrdj.bench.suite import percentiles
+
+
+def item_pairs(writer, nitems, nsegments):
+    '''
+    Return the (item_id, embedding) pairs of one writer.
+    '''
+    offset = writer * nitems
+    return [(offset + item_id, emb) for item_id, emb in
+            synthetic.embeddings(nitems, nsegments, seed=writer)]
+
+
+def write_main(dirpath, writer, nitems, nsegments, batch, results):
+    from vrdj import db
+    got = dict(role='writer', writer=writer, errors=[], items=0)
+    start = time.perf_counter()
+    try:
+        pairs = item_pairs(writer, nitems, nsegments)
+        if writer % 2:
+            store = db.Store(dirpath, checkpoint=1)
+            for item_id, emb in pairs:
+                store.add_embedding(item_id, emb)
+                got['items'] += 1
+        else:
+            store = db.Store(dirpath, checkpoint=0)
+            for first in range(0, len(pairs), batch):
+                store.add_many_embeddings(pairs[first:first + batch])
+                store.flush()
+                got['items'] += len(pairs[first:first + batch])
+        store.close()
+    except Exception as err:
+        got['errors'].append(f'{type(err).__name__}: {err}')
+    got['seconds'] = time.perf_counter() - start
+    results.put(got)
+
+
+def read_main(dirpath, reader, maxid, done, results):
+    from vrdj import db, op
+    got = dict(role='reader', reader=reader, errors=[], latency=[])
+    rng = numpy.random.default_rng(1000 + reader)
+    store = db.Store(dirpath)
+    while not done.is_set():
+        seed = int(rng.integers(1, maxid + 1))
+        start = time.perf_counter()
+        try:
+            store.scheme.refresh()
+            if not store.stored_item_ids([seed]):
+                continue
+            if rng.random() < 0.5:
+                op.similar_average_many(store, [seed], 10)
+            else:
+                op.similar_segment_many(store, [seed], 10)
+        except Exception as err:
+            got['errors'].append(f'{type(err).__name__}: {err}')
+            continue
+        got['latency'].append(time.perf_counter() - start)
+    store.db.close()
+    results.put(got)
+
+
+def check(dirpath, nwriters, nitems, nsegments):
+    '''
+    Return a dict of consistency checks of the store after all writers.
+    '''
+    from vrdj import db
+    store = db.Store(dirpath)
+    expected = dict()
+    for writer in range(nwriters):
+        expected.update(item_pairs(writer, nitems, nsegments))
+    got = dict(items=store.count_embeddings() == len(expected))
+    for kind, index in store.scheme.indices.items():
+        nvectors = sum(len(index.vectorize(emb)) for emb in expected.values())
+        idmap = index.idmap
+        ok = index.index.ntotal == nvectors and len(idmap) == nvectors \
+            and bool((idmap >= 0).all())
+        if ok:
+            for item_id, emb in expected.items():
+                vids = index.get_item_vectors(item_id)
+                vecs = index.vectors([vid for vid, in vids])
+                if not numpy.allclose(vecs, index.vectorize(emb), atol=1e-5):
+                    ok = False
+                    break
+        got[kind] = ok
+    store.close()
+    return got
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--writers', type=int, default=4,
+                        help='Number of writer processes.')
+    parser.add_argument('--readers', type=int, default=4,
+                        help='Number of reader processes.')
+    parser.add_argument('--items', type=int, default=200,
+                        help='Number of items ingested by each writer.')
+    parser.add_argument('--batch', type=int, default=20,
+                        help='Number of items per bulk writer transaction.')
+    parser.add_argument('--segments', type=int, default=10,
+                        help='Mean number of segments per item.')
+    parser.add_argument('--output', default=None,
+                        help='Write the JSON report to this file.')
+    args = parser.parse_args(argv)
+
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    done = ctx.Event()
+    with tempfile.TemporaryDirectory() as tmp:
+        from vrdj import db
+        db.Store(tmp).close()
+
+        start = time.perf_counter()
+        writers = [ctx.Process(target=write_main,
+                               args=(tmp, n, args.items, args.segments, args.batch, results))
+                   for n in range(args.writers)]
+        readers = [ctx.Process(target=read_main,
+                               args=(tmp, n, args.writers * args.items, done, results))
+                   for n in range(args.readers)]
+        for proc in writers + readers:
+            proc.start()
+        got = [results.get() for _ in writers]
+        elapsed = time.perf_counter() - start
+        done.set()
+        got += [results.get() for _ in readers]
+        for proc in writers + readers:
+            proc.join()
+        checks = check(tmp, args.writers, args.items, args.segments)
+
+    errors = [err for one in got for err in one['errors']]
+    latency = [sec for one in got if one['role'] == 'reader' for sec in one['latency']]
+    report = dict(
+        writers=args.writers, readers=args.readers,
+        items=args.writers * args.items,
+        write=dict(seconds=elapsed,
+                   items_per_s=args.writers * args.items / elapsed),
+        query=dict(percentiles(latency) if latency else dict(n=0),
+                   per_s=len(latency) / elapsed),
+        checks=checks, errors=errors[:20], nerrors=len(errors))
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(text + '\n')
+    else:
+        print(text)
+    return 1 if errors or not all(checks.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+'''
+Benchmark the store's ingest, search and ID resolution hot paths.
+
+  python -m vrdj.bench.suite [--sizes 1000,10000,100000] [--segments N]
+                             [--queries Q] [--output FILE]
+
+For each size a fresh store is filled with synthetic embeddings, so neither
+audio nor a model is needed.  Each size runs in its own process so its peak
+RSS is its own.  Reported per size:
+
+- ingest :: Store.add_many_embeddings() throughput in items/s and segment
+  vectors/s.
+- save :: the time to save the average and segment index files.
+- query :: latency percentiles of similar_average_many() and
+  similar_segment_many() with one seed, uncached, in a store freshly opened
+  as "beet vrdj" would open it, and the time of the first (cold) query.
+- resolve :: per-call cost of vector ID to item ID resolution (Index.resolve),
+  fetching embeddings (Store.get_many_embeddings) and fetching an item's
+  vector IDs (Index.get_item_vectors).
+- peak_rss_mb :: the peak resident memory of the process.
+
+The output is one JSON document, written to stdout or to --output, meant to
+be kept and compared across commits.
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+import numpy
+
+from vrdj.bench import synthetic
+
+
+def percentiles(seconds):
+    '''
+    Return a dict of latency percentiles in milliseconds.
+    '''
+    ms = 1000 * numpy.asarray(seconds)
+    return dict(p50=float(numpy.percentile(ms, 50)),
+                p90=float(numpy.percentile(ms, 90)),
+                p99=float(numpy.percentile(ms, 99)),
+                mean=float(ms.mean()), n=len(ms))
+
+
+def timed(func, *args, **kwds):
+    start = time.perf_counter()
+    func(*args, **kwds)
+    return time.perf_counter() - start
+
+
+def peak_rss_mb():
+    # Linux reports kilobytes, macOS bytes.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1 << 20) if sys.platform == 'darwin' else rss / 1024
+
+
+def run_size(nitems, nsegments=30, nqueries=200, batch=1000, seed=0):
+    '''
+    Return the report dict for one store of nitems synthetic items.
+    '''
+    from vrdj import db, op
+
+    report = dict(items=nitems, segments=nsegments)
+    rng = numpy.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = db.Store(tmp, checkpoint=0)
+        nvectors = 0
+        elapsed = 0.0
+        pairs = list()
+        for pair in synthetic.embeddings(nitems, nsegments, seed=seed):
+            pairs.append(pair)
+            if len(pairs) == batch or pair[0] == nitems:
+                nvectors += sum(len(emb) for _, emb in pairs)
+                elapsed += timed(store.add_many_embeddings, pairs)
+                pairs = list()
+        report['ingest'] = dict(seconds=elapsed, items_per_s=nitems / elapsed,
+                                vectors_per_s=nvectors / elapsed,
+                                vectors=nvectors)
+        report['save'] = {kind: dict(seconds=timed(index.flush))
+                          for kind, index in store.scheme.indices.items()}
+        store.close()
+
+        store = db.Store(tmp)
+        seeds = rng.integers(1, nitems + 1, size=nqueries).tolist()
+        query = dict()
+        for mode, func in (('average', op.similar_average_many),
+                           ('segment', op.similar_segment_many)):
+            cold = timed(func, store, [seeds[0]], 10, cache=False)
+            lat = [timed(func, store, [seed], 10, cache=False) for seed in seeds]
+            query[mode] = dict(percentiles(lat), cold_ms=1000 * cold)
+        report['query'] = query
+
+        index = store.scheme.index_segment
+        vids = rng.integers(0, index.index.ntotal, size=10000)
+        ids = rng.integers(1, nitems + 1, size=100).tolist()
+        report['resolve'] = dict(
+            resolve_10k_us=1e6 * numpy.median(
+                [timed(index.resolve, vids) for _ in range(20)]),
+            get_many_embeddings_100_ms=1000 * numpy.median(
+                [timed(store.get_many_embeddings, ids) for _ in range(20)]),
+            get_item_vectors_us=1e6 * numpy.median(
+                [timed(index.get_item_vectors, one) for one in ids]))
+        store.close()
+    report['peak_rss_mb'] = peak_rss_mb()
+    return report
+
+
+def environment():
+    import faiss
+    info = dict(python=platform.python_version(), machine=platform.machine(),
+                system=platform.system(), cpus=os.cpu_count(),
+                numpy=numpy.__version__, faiss=faiss.__version__,
+                time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    try:
+        info['commit'] = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(__file__)).stdout.strip() or None
+    except OSError:
+        info['commit'] = None
+    return info
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='Comma separated numbers of items.')
+    parser.add_argument('--segments', type=int, default=30,
+                        help='Mean number of segments per item.')
+    parser.add_argument('--queries', type=int, default=200,
+                        help='Number of timed queries per mode.')
+    parser.add_argument('--output', default=None,
+                        help='Write the JSON report to this file.')
+    parser.add_argument('--one', type=int, default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.one is not None:
+        print(json.dumps(run_size(args.one, args.segments, args.queries)))
+        return 0
+
+    results = list()
+    for size in [int(one) for one in args.sizes.split(',')]:
+        got = subprocess.run(
+            [sys.executable, '-m', 'vrdj.bench.suite', '--one', str(size),
+             '--segments', str(args.segments), '--queries', str(args.queries)],
+            capture_output=True, text=True)
+        if got.returncode:
+            sys.stderr.write(got.stderr)
+            return got.returncode
+        results.append(json.loads(got.stdout.strip().splitlines()[-1]))
+        print(f'{size} items done', file=sys.stderr)
+
+    text = json.dumps(dict(environment=environment(), results=results), indent=2)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,27 @@
+'''
+Synthetic embeddings for benchmarks which need neither audio nor a model.
+'''
+
+import numpy
+
+
+def embeddings(nitems, nsegments=30, vector_length=128, nclusters=50,
+               quantized=True, seed=0):
+    '''
+    Yield nitems (item_id, embedding) pairs starting from item_id 1.
+
+    Items are drawn around nclusters random centres so that searches have
+    structure to find.  The number of segments of each item varies around
+    nsegments.  If quantized, values are whole numbers in [0, 255] like
+    VGGish's postprocessed output.
+    '''
+    rng = numpy.random.default_rng(seed)
+    centres = rng.uniform(64, 192, size=(nclusters, vector_length))
+    for item_id in range(1, nitems + 1):
+        nseg = max(1, int(rng.normal(nsegments, nsegments / 4)))
+        centre = centres[rng.integers(nclusters)]
+        drift = rng.normal(0, 16, size=vector_length)
+        emb = centre + drift + rng.normal(0, 24, size=(nseg, vector_length))
+        if quantized:
+            emb = numpy.clip(numpy.round(emb), 0, 255)
+        yield item_id, emb.astype('float32')
@@ -0,0 +1,147 @@
+'''
+vrdj query result cache
+
+Results of similarity queries are cached in the store's sqlite DB so repeated
+queries with the same seeds skip vectorizing, searching and resolving.
+
+A result is keyed on the seed item set and the query parameters and is tagged
+with the version of the index which produced it.  For item queries the
+parameters include stamps of the stored seed embeddings so a seed stored again
+gives a new key.  The version changes whenever the index is flushed so stale
+results are never returned.  Results of an index with unflushed changes have
+no version and are not cached.  The least recently used results are evicted
+once the cache holds more than its capacity.  A hit is looked up in a read
+transaction and only then marks the result as used, which is skipped rather
+than waited for while another process writes.
+'''
+
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+from vrdj.util import sqlite_cursor, has_schema
+
+log = logging.getLogger(__name__)
+
+
+class QueryCache:
+    '''
+    A persistent LRU cache of query results.
+    '''
+
+    def __init__(self, db, capacity=1024, tablename='query_cache'):
+        '''
+        Create a cache held in the db.  A capacity of zero disables caching.
+        '''
+        self.db = db
+        self.capacity = capacity
+        self.tablename = tablename
+        self.hits = 0
+        self.misses = 0
+        # Use times of hits not yet written, by key.
+        self._used = dict()
+        self._init_db()
+
+    @staticmethod
+    def key(item_ids, **params):
+        '''
+        Return a key for a query on the set of item_ids with the params.
+        '''
+        text = json.dumps([sorted(set(int(i) for i in item_ids)),
+                           sorted(params.items())])
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def get(self, key, version):
+        '''
+        Return the cached result or None if missing or of another version.
+        '''
+        if not self.capacity or version is None:
+            return None
+        with sqlite_cursor(self.db) as cursor:
+            cursor.execute(
+                f"SELECT version, result FROM {self.tablename} WHERE key = ?",
+                (key,))
+            got = cursor.fetchone()
+        if got is None or got[0] != version:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used[key] = time.time()
+        self._touch()
+        return json.loads(got[1])
+
+    def _touch(self):
+        '''
+        Write the use times of hits unless the database is locked by another
+        writer, in which case they are kept for the next hit or put().
+        '''
+        if self.db.in_transaction:
+            self._write_used(self.db)
+            return
+        timeout = self.db.execute("PRAGMA busy_timeout").fetchone()[0]
+        self.db.execute("PRAGMA busy_timeout = 0")
+        try:
+            with sqlite_cursor(self.db, write=True) as cursor:
+                self._write_used(cursor)
+        except sqlite3.OperationalError as err:
+            log.debug(f'not marking {len(self._used)} cached results used: {err}')
+        finally:
+            self.db.execute(f"PRAGMA busy_timeout = {timeout}")
+
+    def _write_used(self, cursor):
+        cursor.executemany(
+            f"UPDATE {self.tablename} SET used = ? WHERE key = ?",
+            [(used, key) for key, used in self._used.items()])
+        self._used = dict()
+
+    def put(self, key, version, result):
+        '''
+        Cache the JSON-serializable result and evict the least recently used.
+        '''
+        if not self.capacity or version is None:
+            return
+        with sqlite_cursor(self.db, write=True) as cursor:
+            self._write_used(cursor)
+            cursor.execute(
+                f"""
+                INSERT OR REPLACE INTO {self.tablename}
+                (key, version, result, used) VALUES (?, ?, ?, ?)
+                """, (key, version, json.dumps(result), time.time()))
+            cursor.execute(f"SELECT COUNT(*) FROM {self.tablename}")
+            excess = cursor.fetchone()[0] - self.capacity
+            if excess > 0:
+                cursor.execute(
+                    f"""
+                    DELETE FROM {self.tablename} WHERE key IN
+                    (SELECT key FROM {self.tablename} ORDER BY used LIMIT ?)
+                    """, (excess,))
+
+    def clear(self):
+        '''
+        Remove all cached results.
+        '''
+        with sqlite_cursor(self.db, write=True) as cursor:
+            cursor.execute(f"DELETE FROM {self.tablename}")
+
+    def stats(self):
+        '''
+        Return a dict of the hit and miss counters of this process.
+        '''
+        return dict(hits=self.hits, misses=self.misses)
+
+    def _init_db(self):
+        if has_schema(self.db, self.tablename, f'idx_used_{self.tablename}'):
+            return
+        with sqlite_cursor(self.db, write=True) as cursor:
+            cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.tablename} (
+            key TEXT PRIMARY KEY,
+            version TEXT NOT NULL,
+            result TEXT NOT NULL,
+            used REAL NOT NULL
+            );
+            """)
+            cursor.execute(f"""
+            CREATE INDEX IF NOT EXISTS idx_used_{self.tablename}
+            ON {self.tablename} (used);""")
@@ -1,22 +1,25 @@
 import click
-import os
 from pathlib import Path
 import logging
 import numpy as np
-import random
-from typing import List
-import yaml
 
 # Set up simple logging for the CLI
 logging.basicConfig(level=logging.DEBUG, format='%(levelname)s: %(message)s')
 _log = logging.getLogger(__name__)
 
 class Main:
-    def __init__(self, directory, metric, embedding, device):
+    def __init__(self, directory, metric, embedding, device,
+                 index_type='flat', index_options=None, codec='f32',
+                 model_options=None, reduce=None):
         self._directory = directory
         self._metric = metric
         self._embedding = embedding
         self._device = device
+        self._index_type = index_type
+        self._index_options = index_options or {}
+        self._codec = codec
+        self._model_options = model_options or {}
+        self._reduce = reduce
 
     @property
     def store(self):
@@ -28,10 +31,43 @@ class Main:
                 self._directory = (beetface.dbpath().parent / "vrdj").absolute()
             self._store = db.Store(self._directory,
                                    metric=self._metric,
-                                   embedding=self.embedding,
-                                   device=self._device)
+                                   embedding=self._embedding,
+                                   device=self._device,
+                                   index_type=self._index_type,
+                                   index_options=self._index_options,
+                                   reduce=self._reduce,
+                                   codec=self._codec,
+                                   model_options=self._model_options)
         return self._store
 
+def parse_index_options(ctx, param, value):
+    '''
+    Parse KEY=VALUE index options into a dict of ints.
+    '''
+    options = dict()
+    for one in value:
+        key, sep, val = one.partition('=')
+        if not sep:
+            raise click.BadParameter(f'expect KEY=VALUE, got "{one}"')
+        try:
+            options[key] = int(val)
+        except ValueError:
+            raise click.BadParameter(f'expect an integer value, got "{one}"')
+    return options
+
+def parse_reduce(ctx, param, value):
+    '''
+    Check the reduction of vectors, eg "pcaw64".
+    '''
+    if not value:
+        return None
+    from vrdj.scheme import parse_reduce
+    try:
+        parse_reduce(value)
+    except ValueError as err:
+        raise click.BadParameter(str(err))
+    return value
+
 @click.group()
 @click.option('-d', '--directory',
               default=None,
@@ -40,18 +76,56 @@ class Main:
                               resolve_path=True, writable=True, path_type=Path))
 @click.option('-m', '--metric', default='cosine',
               help='Comparison metric.')
-@click.option('-m', '--embedding', default='vggish',
-              help='Embedding model.')
+@click.option('-e', '--embedding', default='vggish',
+              help='Embedding model, vggish or one of a "vrdj.embeddings" entry point.')
 @click.option('--device', default='cpu',
               help='Device for torch',
               type=click.Choice(["cpu","cuda"])) # fixme: add more
+@click.option('--index', 'index_type', default='flat',
+              help='FAISS index type.',
+              type=click.Choice(['flat', 'ivf', 'hnsw', 'ivfpq']))
+@click.option('-o', '--index-option', 'index_options', multiple=True,
+              callback=parse_index_options,
+              help='FAISS index option as KEY=VALUE (nlist, nprobe, hnsw_m, ef_search, pq_m).')
+@click.option('--reduce', default=None, callback=parse_reduce,
+              help='Reduce vectors before indexing: pcaN, pcawN (whitened PCA) or opqN, eg pcaw64.')
+@click.option('--codec', default='f32',
+              help='Encoding of newly stored embeddings.',
+              type=click.Choice(['f32', 'f16', 'u8']))
+@click.option('--compile', 'compile_', default=None,
+              help='Compile the embedding model.',
+              type=click.Choice(['torch', 'script']))
+@click.option('--threads', default=None, type=int,
+              help='Number of CPU threads for the embedding model.')
+@click.option('--profile', is_flag=True, default=False,
+              help='Print the time spent in each stage on exit.')
+@click.option('--profile-output', default=None,
+              type=click.Path(dir_okay=False, path_type=Path),
+              help='Write the per-stage times as JSON to this file on exit.')
 @click.pass_context
-def cli(ctx, directory, metric, embedding, device):
+def cli(ctx, directory, metric, embedding, device, index_type, index_options,
+        reduce, codec, compile_, threads, profile, profile_output):
     """
     Virtual Radio DJ (VRDJ) CLI for indexing and searching audio similarity 
     based on VGGish embeddings and Faiss.
     """
-    ctx.obj = Main(directory, metric, embedding, device)
+    model_options = dict()
+    if compile_:
+        model_options['compile'] = compile_
+    if threads:
+        model_options['threads'] = threads
+    ctx.obj = Main(directory, metric, embedding, device,
+                   index_type, index_options, codec, model_options, reduce)
+    if profile or profile_output:
+        from vrdj import trace
+        trace.enable()
+
+        def report():
+            if profile:
+                print(trace.report())
+            if profile_output:
+                trace.export(profile_output)
+        ctx.call_on_close(report)
 
 
 @cli.command('beets')
@@ -63,23 +137,221 @@ def beets(ctx):
     print(f'{beetface.music_directory()=}')
 
 @cli.command('ingest')
+@click.option('-j', '--workers', default=0, type=int,
+              help='Number of audio decode processes (default: number of CPUs).')
+@click.option('-b', '--batch-size', default=32, type=int,
+              help='Number of items to embed and commit together.')
+@click.option('-c', '--checkpoint', default=1024, type=int,
+              help='Save vector indices every this many items (0: only at the end).')
+@click.option('-f', '--force', is_flag=True, default=False,
+              help='Recalculate embeddings that are already stored.')
 @click.argument('filepaths', nargs=-1, type=click.Path(exists=True))
 @click.pass_context
-def cmd_ingest(ctx, filepaths):
+def cmd_ingest(ctx, workers, batch_size, checkpoint, force, filepaths):
     '''
     Ingest files into the index.
     '''
     from vrdj import beetface
+    from vrdj.ingest import bulk_ingest
     lib = beetface.library()
+    items = list()
     for item_path in filepaths:
-        print(f'ingesting {item_path}')
         item = beetface.item_at_path(lib, item_path)
         if not item:
             print(f'failed to get {item_path}')
             continue
-        item_path = item.path.decode()
-        print(f'ingesting {item.id} {item_path}')
-        ctx.obj.store.add_embedding(item.id, item_path)
+        items.append((item.id, item.path.decode()))
+
+    def progress(stats):
+        print(f'ingesting: {stats}')
+
+    stats = bulk_ingest(ctx.obj.store, items, workers=workers or None,
+                        batch_size=batch_size, force=force,
+                        checkpoint=checkpoint, progress=progress)
+    print(f'ingested: {stats}')
+
+
+@cli.command('rebuild')
+@click.option('-k', '--kind', default='all',
+              type=click.Choice(['average', 'segment', 'all']),
+              help='Which index to rebuild.')
+@click.option('--train-size', default=100000, type=int,
+              help='Maximum number of vectors used to train the index.')
+@click.option('--evaluate', 'nqueries', default=0, type=int,
+              help='Report recall and latency against the flat index using this many queries.')
+@click.option('-n', '--number', default=10, type=int,
+              help='Number of results per query when evaluating.')
+@click.pass_context
+def cmd_rebuild(ctx, kind, train_size, nqueries, number):
+    '''
+    Rebuild indices of the selected --index type from stored embeddings.
+
+    Use this to migrate an existing store to a new index type.
+    '''
+    import time
+    from vrdj.op import rebuild_index, compare_indices
+    from vrdj.scheme import Index
+    store = ctx.obj.store
+    kinds = ['average', 'segment'] if kind == 'all' else [kind]
+    for kind in kinds:
+        index = store.scheme.indices[kind]
+        start = time.monotonic()
+
+        def progress(done):
+            print(f'{kind}: {done} items in {time.monotonic() - start:.1f}s')
+
+        with store.writing():
+            nitems = rebuild_index(store, index, train_size=train_size,
+                                   progress=progress)
+        print(f'{kind}: rebuilt {index.filepath} with {nitems} items, '
+              f'{index.index.ntotal} vectors in {time.monotonic() - start:.1f}s')
+
+        if not nqueries:
+            continue
+        if index.index_type == 'flat' and not index.reduce:
+            print(f'{kind}: not evaluating flat index against itself')
+            continue
+        baseline = Index(kind, index.dirpath, store.db,
+                         metric=index._metric, embedding=index._embedding)
+        if baseline.index.ntotal == 0:
+            print(f'{kind}: no flat index to evaluate against, run "vrdj rebuild" with "--index flat"')
+            continue
+        rng = np.random.default_rng(0)
+        queries = list()
+        for _, emb in store.iter_embeddings():
+            vecs = index.vectorize(emb, reduce=False)
+            queries.append(vecs[rng.integers(len(vecs))])
+        queries = np.vstack(queries)
+        if len(queries) > nqueries:
+            queries = queries[rng.choice(len(queries), nqueries, replace=False)]
+        got = compare_indices(index, baseline, queries, number)
+        print(f'{kind}: recall@{number}={got["recall"]:.3f} '
+              f'latency={got["test_ms"]:.3f}ms vs flat {got["baseline_ms"]:.3f}ms '
+              f'over {got["nqueries"]} queries')
+
+
+@cli.command('reindex')
+@click.option('-c', '--chunk-size', default=1000, type=int,
+              help='Number of items read and vectorized together.')
+@click.option('--train-size', default=100000, type=int,
+              help='Maximum number of vectors used to train the index.')
+@click.pass_context
+def cmd_reindex(ctx, chunk_size, train_size):
+    '''
+    Regenerate all indices from stored embeddings.
+
+    Use this to recover lost or damaged index files or to make the indices of
+    a new --metric.  Each index is built in memory and then replaces its file
+    and vector ID table at once so queries meanwhile use the old one.
+    '''
+    import time
+    from vrdj.op import rebuild_index
+    store = ctx.obj.store
+    begin = time.monotonic()
+    with store.writing():
+        for kind, index in store.scheme.indices.items():
+            start = time.monotonic()
+
+            def progress(done):
+                elapsed = time.monotonic() - start
+                print(f'{kind}: {done} items in {elapsed:.1f}s, '
+                      f'{done / max(elapsed, 1e-9):.1f} items/s')
+
+            nitems = rebuild_index(store, index, train_size=train_size,
+                                   progress=progress, chunk_size=chunk_size)
+            elapsed = max(time.monotonic() - start, 1e-9)
+            nvectors = index.index.ntotal
+            print(f'{kind}: indexed {nitems} items, {nvectors} vectors in {elapsed:.1f}s, '
+                  f'{nitems / elapsed:.1f} items/s, {nvectors / elapsed:.1f} vectors/s')
+        for kind, index in store.scheme.centroids.items():
+            start = time.monotonic()
+            count = index.rebuild()
+            print(f'{kind}: indexed {count} centroids in {time.monotonic() - start:.1f}s')
+    print(f'reindexed {index.dirpath} in {time.monotonic() - begin:.1f}s')
+
+
+@cli.command('recode')
+@click.option('--vacuum/--no-vacuum', default=True,
+              help='Reclaim the freed space in the store file afterwards.')
+@click.pass_context
+def cmd_recode(ctx, vacuum):
+    '''
+    Re-encode all stored embeddings with the selected --codec.
+    '''
+    import time
+    store = ctx.obj.store
+    size = store.sqlite_filepath.stat().st_size
+    start = time.monotonic()
+
+    def progress(done):
+        print(f'recoded {done} embeddings in {time.monotonic() - start:.1f}s')
+
+    store.recode(progress=progress)
+    if vacuum:
+        store.vacuum()
+    print(f'{store.sqlite_filepath}: {size} -> {store.sqlite_filepath.stat().st_size} bytes')
+
+
+@cli.command('knn-build')
+@click.option('-k', '--neighbours', default=50, type=int,
+              help='Number of neighbours kept per item.')
+@click.option('--block', default=4096, type=int,
+              help='Number of items searched together.')
+@click.pass_context
+def cmd_knn_build(ctx, neighbours, block):
+    '''
+    Precompute the nearest neighbours of every item.
+
+    Single-seed similarity queries are then answered by lookup.  The graph is
+    extended once every thousand or so new items are ingested.
+    '''
+    import time
+    graph = ctx.obj.store.scheme.knn
+    start = time.monotonic()
+
+    def progress(done):
+        elapsed = time.monotonic() - start
+        print(f'{done} items in {elapsed:.1f}s, {done / max(elapsed, 1e-9):.1f} items/s')
+
+    with ctx.obj.store.writing():
+        graph.build(k=neighbours, block=block, progress=progress)
+    print(f'wrote {graph.items_path} and {graph.scores_path}')
+
+
+@cli.command('compact')
+@click.pass_context
+def cmd_compact(ctx):
+    '''
+    Merge the delta files of each index into its base index file.
+    '''
+    import time
+    start = time.monotonic()
+    store = ctx.obj.store
+    with store.writing():
+        merged = store.scheme.compact()
+    for kind, count in merged.items():
+        print(f'{kind}: merged {count} delta files')
+    print(f'compacted in {time.monotonic() - start:.1f}s')
+
+
+@cli.command('serve')
+@click.option('-s', '--socket', 'socket_path', default=None,
+              type=click.Path(dir_okay=False, path_type=Path),
+              help='Unix socket path (default: vrdj.sock in the store directory).')
+@click.option('-j', '--threads', default=0, type=int,
+              help='Number of threads FAISS searches with (0: one per core).')
+@click.pass_context
+def cmd_serve(ctx, socket_path, threads):
+    '''
+    Answer similarity queries from the beets plugin and other clients.
+    '''
+    import sys
+    import signal
+    from vrdj.server import Server
+    server = Server(ctx.obj.store, socket_path, threads=threads)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    print(f'serving on {server.path}')
+    server.serve_forever()
 
 
 def main():
@@ -0,0 +1,134 @@
+'''
+vrdj query client
+
+A thin client of the "vrdj serve" query server.  Messages in both directions
+are a 4-byte big-endian length followed by that many bytes of UTF-8 JSON.
+Each connection carries one request and its reply.
+
+This module imports neither numpy nor FAISS so that clients start fast.
+'''
+
+import json
+import socket
+import struct
+
+
+class ServerError(RuntimeError):
+    '''
+    The server failed to answer a request.
+    '''
+
+
+def send_message(sock, obj):
+    '''
+    Send a JSON-able object as one message.
+    '''
+    data = json.dumps(obj).encode()
+    sock.sendall(struct.pack('>I', len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    chunks = list()
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(sock):
+    '''
+    Return the next message object or None if the peer closed the connection.
+    '''
+    header = _recv_exactly(sock, 4)
+    if header is None:
+        return None
+    data = _recv_exactly(sock, struct.unpack('>I', header)[0])
+    if data is None:
+        return None
+    return json.loads(data)
+
+
+class Client:
+    '''
+    Make requests of a vrdj query server listening on a Unix socket path.
+    '''
+
+    def __init__(self, path, timeout=30.0):
+        self.path = str(path)
+        self.timeout = timeout
+
+    def request(self, op, **params):
+        '''
+        Return the result of one request.
+
+        Raise OSError if the server can not be reached and ServerError if it
+        fails to answer.
+        '''
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            send_message(sock, dict(params, op=op))
+            reply = recv_message(sock)
+        if reply is None:
+            raise ServerError('server closed the connection')
+        if not reply.get('ok'):
+            raise ServerError(reply.get('error', 'unknown error'))
+        return reply['result']
+
+    def ping(self):
+        '''
+        Return server info or None if no server answers.
+        '''
+        try:
+            return self.request('ping')
+        except (OSError, ServerError):
+            return None
+
+    def stored(self, item_ids):
+        '''
+        Return the set of item_ids stored in the server's store.
+        '''
+        got = self.request('stored', item_ids=[int(one) for one in item_ids])
+        return set(got['item_ids'])
+
+    def similar(self, item_ids, count, mode='average', aggregate='max', cache=True,
+                allowed=None, diversity=0.0):
+        '''
+        Return item IDs similar to item_ids as for vrdj.op.similar_average_many()
+        or, with mode "segment", vrdj.op.similar_segment_many().
+        '''
+        params = dict(item_ids=list(item_ids), count=count, mode=mode,
+                      aggregate=aggregate, cache=cache)
+        if diversity:
+            params['diversity'] = float(diversity)
+        if allowed is not None:
+            params['allowed'] = [int(one) for one in allowed]
+        got = self.request('similar', **params)
+        return got['item_ids']
+
+    def similar_groups(self, kind, names, count, cache=True, allowed=None):
+        '''
+        Return names of groups similar to the named groups as for
+        vrdj.op.similar_groups().
+        '''
+        params = dict(kind=kind, names=[str(one) for one in names], count=count,
+                      cache=cache)
+        if allowed is not None:
+            params['allowed'] = [str(one) for one in allowed]
+        return self.request('similar_groups', **params)['names']
+
+    def stats(self):
+        return self.request('stats')
+
+
+def connect(path, timeout=30.0):
+    '''
+    Return a Client of the server at path or None if none answers.
+    '''
+    client = Client(path, timeout)
+    if client.ping() is None:
+        return None
+    return client
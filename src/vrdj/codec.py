@@ -0,0 +1,109 @@
+'''
+vrdj embedding codec
+
+Embeddings are stored as BLOBs with a small header recording their shape and
+encoding.  All numbers are little-endian.  The 16 byte header is:
+
+- magic :: the 4 bytes b'VRDJ'
+- version :: uint8, currently 1
+- codec :: uint8, index into "codecs"
+- reserved :: 2 bytes, zero
+- nrows, ncols :: uint32 each, the embedding shape
+
+The payload depends on the codec:
+
+- f32 :: nrows*ncols float32 values.
+- f16 :: nrows*ncols float16 values.
+- u8 :: per row float32 offset and scale (nrows*2 float32) followed by
+  nrows*ncols uint8 values.  A value is decoded as offset + scale*q.
+
+The "u8" codec is lossless for VGGish's native postprocessed output which
+holds whole numbers in [0, 255].  Other rows are scaled to their range.
+
+BLOBs without the magic predate the codec and hold raw float32 values.
+'''
+
+import struct
+import numpy
+
+magic = b'VRDJ'
+version = 1
+codecs = ('f32', 'f16', 'u8')
+
+_header = struct.Struct('<4sBBxxII')
+
+
+def encode(tensor, codec='f32'):
+    '''
+    Return bytes encoding the 2D tensor.
+    '''
+    tensor = numpy.asarray(tensor, dtype='float32')
+    if tensor.ndim == 1:
+        tensor = tensor.reshape(1, -1)
+    nrows, ncols = tensor.shape
+    try:
+        code = codecs.index(codec)
+    except ValueError:
+        raise ValueError(f'unsupported codec: {codec}')
+    header = _header.pack(magic, version, code, nrows, ncols)
+
+    if codec == 'f32':
+        return header + tensor.astype('<f4').tobytes()
+    if codec == 'f16':
+        return header + tensor.astype('<f2').tobytes()
+
+    if tensor.size == 0:
+        # No values to scale, eg audio too short for one example.
+        return header + numpy.zeros((nrows, 2), dtype='<f4').tobytes()
+    lo = tensor.min(axis=1)
+    hi = tensor.max(axis=1)
+    scale = (hi - lo) / 255.0
+    # Rows already holding bytes are kept exact.
+    native = (lo >= 0) & (hi <= 255) & numpy.all(tensor == numpy.round(tensor), axis=1)
+    lo = numpy.where(native, 0.0, lo)
+    scale = numpy.where(native, 1.0, numpy.where(scale > 0, scale, 1.0))
+    quant = numpy.round((tensor - lo[:, None]) / scale[:, None])
+    quant = numpy.clip(quant, 0, 255).astype('u1')
+    params = numpy.stack([lo, scale], axis=1).astype('<f4')
+    return header + params.tobytes() + quant.tobytes()
+
+
+def decode(blob, vector_length=None):
+    '''
+    Return the float32 tensor encoded in blob.
+
+    The vector_length is only needed to decode BLOBs written before the codec.
+    '''
+    if blob is None or len(blob) == 0:
+        return None
+    if bytes(blob[:4]) != magic:
+        if vector_length is None:
+            raise ValueError('vector_length is required to decode a raw blob')
+        return numpy.frombuffer(blob, dtype='<f4').reshape(-1, vector_length)
+
+    _, ver, code, nrows, ncols = _header.unpack_from(blob)
+    if ver != version:
+        raise ValueError(f'unsupported embedding codec version: {ver}')
+    codec = codecs[code]
+    offset = _header.size
+    count = nrows * ncols
+    if codec == 'f32':
+        return numpy.frombuffer(blob, dtype='<f4', count=count,
+                                offset=offset).reshape(nrows, ncols)
+    if codec == 'f16':
+        return numpy.frombuffer(blob, dtype='<f2', count=count,
+                                offset=offset).reshape(nrows, ncols).astype('float32')
+    params = numpy.frombuffer(blob, dtype='<f4', count=2 * nrows,
+                              offset=offset).reshape(nrows, 2)
+    quant = numpy.frombuffer(blob, dtype='u1', count=count,
+                             offset=offset + params.nbytes).reshape(nrows, ncols)
+    return (params[:, :1] + params[:, 1:] * quant).astype('float32')
+
+
+def codec_of(blob):
+    '''
+    Return the name of the codec of blob, "raw" if it predates the codec.
+    '''
+    if bytes(blob[:4]) != magic:
+        return 'raw'
+    return codecs[_header.unpack_from(blob)[2]]
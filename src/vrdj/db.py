@@ -9,26 +9,29 @@ provided externally from vrdj, but it is intended to be a beets item.id.
 
 import os
 import time
-import sqlite3
+import logging
 import numpy as np
 from pathlib import Path
+from contextlib import contextmanager
 from vrdj.scheme import Scheme
+from vrdj.cache import QueryCache
 import vrdj.embeddings
+import vrdj.codec
 
-from vrdj.util import sqlite_cursor
+from vrdj.util import sqlite_cursor, sqlite_connect, chunked, WriteLock, has_schema
+from vrdj import trace
 
-def tensor_to_blob(tensor: np.ndarray) -> bytes:
-    """Converts a NumPy array into a raw byte BLOB for SQLite storage."""
-    # Ensure it's stored as little-endian float32 for portability and consistency
-    return tensor.astype('<f4').tobytes()
+log = logging.getLogger(__name__)
+
+def tensor_to_blob(tensor: np.ndarray, codec: str = 'f32') -> bytes:
+    """Converts a NumPy array into a BLOB for SQLite storage, see vrdj.codec."""
+    return vrdj.codec.encode(tensor, codec)
 
 def blob_to_tensor(blob: bytes, vector_size: int) -> np.ndarray:
     """Reconstitutes a NumPy array from a BLOB."""
     if not blob:
         return None
-    # Read as little-endian float32 and reshape to (N, D)
-    return np.frombuffer(blob, dtype='<f4').reshape(-1, vector_size)
-    # fixme: store shape in DB
+    return vrdj.codec.decode(blob, vector_size)
 
 class Store:
     '''
@@ -41,7 +44,14 @@ class Store:
     def __init__(self, dirpath: str|Path,
                  metric: str = 'cosine',
                  embedding: str = 'vggish',
-                 device: str ='cpu'):
+                 device: str ='cpu',
+                 checkpoint: int = 1,
+                 index_type: str = 'flat',
+                 index_options: dict|None = None,
+                 reduce: str|None = None,
+                 codec: str = 'f32',
+                 cache_size: int = 1024,
+                 model_options: dict|None = None):
         '''
         Create a vrdj store.
 
@@ -50,6 +60,18 @@ class Store:
         name and the vector indexing is done on a per scheme basis.  Multiple
         stores can share the embeddings and the unique vector index tables will
         be kept distinct by their name.
+
+        The checkpoint gives the number of added items after which the vector
+        indices are saved.  Zero defers saving to flush() or close().  The
+        index_type and index_options select the FAISS index structure and
+        reduce how vectors are reduced before indexing, see vrdj.scheme.  New
+        embeddings are stored with the codec, see vrdj.codec.  Up to
+        cache_size query results are cached, see vrdj.cache.  Any
+        model_options are passed to the embedding model, eg compile and
+        threads for vggish.
+
+        Many stores, in one or many processes, may read the same directory
+        while one of them writes, see writing().
         '''
 
         dirpath = Path(dirpath)
@@ -57,17 +79,87 @@ class Store:
         #print(f'vrdj store in: {dirpath}')
         self.dirpath = dirpath
 
-        emod = getattr(vrdj.embeddings, embedding)
+        emod = vrdj.embeddings.get(embedding)
+        self.embedding_module = emod
         self.vector_length = emod.vector_length
-        self.model = emod.Model(device)
+        self._device = device
+        self._model_options = model_options or {}
+        if codec not in vrdj.codec.codecs:
+            raise ValueError(f'unsupported codec: {codec}')
+        self.codec = codec
 
         self.sqlite_filepath = dirpath / "store.sqlite"
+        self.lock = WriteLock(dirpath / "write.lock")
+        self._writers = 0
         self.tablename = f'embedding_{embedding}'
 
+        # Opening does not wait on a writer.  Existing tables are left alone,
+        # missing ones are created each in one sqlite transaction and only a
+        # migration of stored rows takes the writer lock.
         self._init_sqlite()
-
         self.scheme = Scheme(dirpath, db=self.db,
-                             metric=metric, embedding=embedding)
+                             metric=metric, embedding=embedding,
+                             checkpoint=checkpoint,
+                             index_type=index_type,
+                             index_options=index_options,
+                             reduce=reduce)
+        self.cache = QueryCache(self.db, capacity=cache_size)
+
+    @property
+    def model(self):
+        '''
+        The embedding model, created on first use.
+        '''
+        if not hasattr(self, '_model'):
+            self._model = self.embedding_module.Model(self._device,
+                                                      **self._model_options)
+        return self._model
+
+    @contextmanager
+    def writing(self, wait=True):
+        '''
+        Context in which this store may change its files.
+
+        The store's writer lock is taken so only one process writes at a time.
+        On first taking it, indices changed on disk by the previous writer are
+        reloaded so new vectors follow on from theirs.  The lock is released
+        on leaving the outermost context once all additions are flushed, else
+        it is held until flush() or close().  If wait is False and another
+        process holds the lock, raise BlockingIOError.
+        '''
+        if self.lock.acquire(wait) and hasattr(self, 'scheme'):
+            self.scheme.refresh()
+        self._writers += 1
+        try:
+            yield self
+        finally:
+            self._writers -= 1
+            if not self._writers and not self._dirty():
+                self.lock.release()
+
+    def _dirty(self):
+        return hasattr(self, 'scheme') and self.scheme.pending
+
+    def flush(self):
+        '''
+        Save vector indices and their pending mappings.
+
+        A store which added nothing has nothing to save and does not wait for
+        the writer lock.
+        '''
+        if not self._dirty() and not self.lock.held:
+            return
+        with self.writing():
+            self.scheme.flush()
+
+    def close(self):
+        '''
+        Flush and close the store.
+        '''
+        if self._dirty() or self.lock.held:
+            with self.writing():
+                self.scheme.close()
+        self.db.close()
 
 
     def get_embedding(self, item_id):
@@ -83,50 +175,269 @@ class Store:
                 return
             return blob_to_tensor(result[0], self.vector_length)
 
-    def get_many_embeddings(self, item_ids):
+    def get_many_embeddings(self, item_ids, chunk_size=500):
+        '''
+        Return a dict mapping item_id to embedding for the stored item_ids.
+
+        Embeddings are fetched with one query per chunk of item_ids.
+        '''
+        found = dict()
+        with trace.span('store.get_embeddings') as span, \
+             sqlite_cursor(self.db) as cursor:
+            for chunk in chunked(item_ids, chunk_size):
+                marks = ','.join('?' * len(chunk))
+                cursor.execute(
+                    f"SELECT item_id, embedding FROM {self.tablename} "
+                    f"WHERE item_id IN ({marks})", chunk)
+                for item_id, blob in cursor.fetchall():
+                    span.add(1, len(blob))
+                    found[item_id] = blob_to_tensor(blob, self.vector_length)
+        return found
+
+    def count_embeddings(self):
         '''
-        Return embeddings for item_ids
+        Return the number of stored embeddings.
         '''
-        return map(self.get_embedding, item_ids)
+        with sqlite_cursor(self.db) as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM {self.tablename}")
+            return cursor.fetchone()[0]
+
+    def iter_embeddings(self, chunk_size=1000):
+        '''
+        Yield (item_id, embedding) for all stored embeddings in item order.
+        '''
+        last = None
+        while True:
+            with sqlite_cursor(self.db) as cursor:
+                if last is None:
+                    cursor.execute(
+                        f"SELECT item_id, embedding FROM {self.tablename} "
+                        "ORDER BY item_id LIMIT ?", (chunk_size,))
+                else:
+                    cursor.execute(
+                        f"SELECT item_id, embedding FROM {self.tablename} "
+                        "WHERE item_id > ? ORDER BY item_id LIMIT ?",
+                        (last, chunk_size))
+                rows = cursor.fetchall()
+            if not rows:
+                return
+            for item_id, blob in rows:
+                yield item_id, blob_to_tensor(blob, self.vector_length)
+            last = rows[-1][0]
 
+    def recode(self, codec=None, chunk_size=1000, progress=None):
+        '''
+        Re-encode all stored embeddings with codec, default the store's codec.
+
+        Each chunk of embeddings is rewritten in one transaction.  If given,
+        progress is called with the number of embeddings done so far.  Return
+        that number.
+        '''
+        codec = codec or self.codec
+        done = 0
+        batch = list()
+
+        def write():
+            with sqlite_cursor(self.db, write=True) as cursor:
+                cursor.executemany(
+                    f"UPDATE {self.tablename} SET embedding = ? WHERE item_id = ?",
+                    batch)
+
+        with self.writing():
+            for item_id, emb in self.iter_embeddings(chunk_size):
+                batch.append((tensor_to_blob(emb, codec), item_id))
+                if len(batch) == chunk_size:
+                    write()
+                    done += len(batch)
+                    batch = list()
+                    if progress:
+                        progress(done)
+            if batch:
+                write()
+                done += len(batch)
+                if progress:
+                    progress(done)
+        return done
+
+    def vacuum(self):
+        '''
+        Reclaim unused space in the store file.
+
+        In WAL mode VACUUM writes the new pages to the -wal file so they are
+        then checkpointed into the store file and the -wal file truncated.
+        '''
+        self.db.execute("VACUUM")
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
 
-    def add_embedding(self, item_id, source, force=False):
+    def stored_item_ids(self, item_ids):
+        '''
+        Return the set of item_ids which have a stored embedding.
+        '''
+        found = set()
+        with sqlite_cursor(self.db) as cursor:
+            for chunk in chunked(item_ids, 500):
+                marks = ','.join('?' * len(chunk))
+                cursor.execute(
+                    f"SELECT item_id FROM {self.tablename} WHERE item_id IN ({marks})",
+                    chunk)
+                found.update(row[0] for row in cursor.fetchall())
+        return found
+
+    def embedding_stamps(self, item_ids):
+        '''
+        Return a sorted list of (item_id, rowid, created) of the stored
+        embeddings of item_ids.
+
+        This changes whenever an embedding of one of the items is stored again
+        so it may key results computed from them, see QueryCache.
+        '''
+        found = list()
+        with sqlite_cursor(self.db) as cursor:
+            for chunk in chunked(sorted(set(item_ids)), 500):
+                marks = ','.join('?' * len(chunk))
+                cursor.execute(
+                    f"""
+                    SELECT item_id, id, created FROM {self.tablename}
+                    WHERE item_id IN ({marks})
+                    """, chunk)
+                found += cursor.fetchall()
+        return sorted(found)
+
+    def add_many_embeddings(self, pairs, groups=None):
+        '''
+        Store many (item_id, embedding) pairs and index their vectors.
+
+        Unlike add_embedding(), this always (re)stores and all embeddings are
+        committed in a single transaction.  If given, groups maps item IDs to
+        their groups as for Scheme.add_groups().
+        '''
+        pairs = list(pairs)
+        now = time.time()
+        with self.writing():
+            with trace.span('store.add_embeddings', items=len(pairs)) as span:
+                rows = [(item_id, tensor_to_blob(emb, self.codec), now) for item_id, emb in pairs]
+                span.add(nbytes=sum(len(row[1]) for row in rows))
+                with sqlite_cursor(self.db, write=True) as cursor:
+                    cursor.executemany(
+                        f"""
+                        INSERT OR REPLACE INTO {self.tablename}
+                        (item_id, embedding, created)
+                        VALUES (?, ?, ?)
+                        """, rows)
+            self.scheme.add_embeddings(pairs, groups)
+
+    def add_embedding(self, item_id, source, force=False, groups=None):
         '''
         Store an item's embedding and index its vectors.
 
         If item_id is already stored, this will not restore unless force=True
 
-        The source may be an embedding tensor or a audio filename.
+        If given, groups is a dict from centroid kind, eg "album", to the name
+        of the item's group of that kind, see Scheme.add_groups().
+
+        The source may be an embedding tensor or a audio filename.  An audio
+        file is embedded in batches of segments whose vectors are indexed batch
+        by batch once the embedding is stored, so nothing is indexed if the
+        audio fails part way through.
         '''
         embedding = self.get_embedding(item_id)
         if embedding is not None and not force:
             # print(f"already have embedding for {item_id=}")
+            if groups:
+                self.add_groups({item_id: groups})
             return
 
-        if isinstance(source, np.ndarray):
-            embedding = source
-        else:
-            embedding = self.model.embedding(source)
-            
-        blob = tensor_to_blob(embedding)
-        with sqlite_cursor(self.db) as cursor:
-            cursor.execute(
-                f"""
-                INSERT OR REPLACE INTO {self.tablename}
-                (item_id, embedding, created)
-                VALUES (?, ?, ?)
-                """,
-                (item_id, blob, time.time()))
-        # forward to scheme no matter what
-        self.scheme.add_embedding(item_id, embedding)
+        with trace.span('store.add_embedding', items=1) as span:
+            parts = None
+            if isinstance(source, np.ndarray):
+                embedding = source
+            elif hasattr(self.model, 'embedding_stream'):
+                parts = self._embed_stream(source)
+                embedding = np.vstack(parts)
+            else:
+                embedding = self.model.embedding(source)
+
+            blob = tensor_to_blob(embedding, self.codec)
+            span.add(nbytes=len(blob))
+            with self.writing():
+                with sqlite_cursor(self.db, write=True) as cursor:
+                    cursor.execute(
+                        f"""
+                        INSERT OR REPLACE INTO {self.tablename}
+                        (item_id, embedding, created)
+                        VALUES (?, ?, ?)
+                        """,
+                        (item_id, blob, time.time()))
+                index = self.scheme.index_segment
+                if parts and not index.indexed_item_ids([item_id]):
+                    first = 0
+                    for emb in parts:
+                        index.add_segments(item_id, emb, first)
+                        first += len(emb)
+                # forward to scheme no matter what
+                self.scheme.add_embeddings([(item_id, embedding)],
+                                           {item_id: groups} if groups else None)
+
+    def add_groups(self, groups, chunk_size=1000, wait=True):
+        '''
+        Add stored items to the centroids of their groups.
+
+        The groups maps item IDs to their groups as for Scheme.add_groups().
+        Items which are not stored or are already in a group are skipped so
+        this may be repeated to add only new items.  The writer lock is only
+        taken if some item needs adding and, if wait is False, nothing is
+        added while another process writes.  Return the number of stored items
+        added.
+        '''
+        todo = self._ungrouped(groups, chunk_size)
+        if not todo:
+            return 0
+        done = 0
+        try:
+            with self.writing(wait):
+                # Another writer may have added some while we waited.
+                for chunk in chunked(self._ungrouped(todo, chunk_size), chunk_size):
+                    embs = self.get_many_embeddings(chunk)
+                    self.scheme.add_groups(embs.items(), groups)
+                    done += len(embs)
+                self.scheme.flush()
+        except BlockingIOError:
+            log.info(f'not adding {len(todo)} items to groups while another process writes')
+        return done
+
+    def _ungrouped(self, item_ids, chunk_size=1000):
+        '''
+        Return the stored item_ids missing from some centroid index.
+        '''
+        todo = list()
+        for chunk in chunked(item_ids, chunk_size):
+            members = [ind.member_item_ids(chunk)
+                       for ind in self.scheme.centroids.values()]
+            chunk = [one for one in chunk if not all(one in m for m in members)]
+            if chunk:
+                stored = self.stored_item_ids(chunk)
+                todo += [one for one in chunk if one in stored]
+        return todo
+
+    def _embed_stream(self, filepath):
+        '''
+        Return the list of embedding batches of an audio file.
+        '''
+        parts = list(self.model.embedding_stream(filepath))
+        if not parts:
+            raise ValueError(f'no audio examples in {filepath}')
+        return parts
 
     def _init_sqlite(self):
         """Initializes the SQLite connection and creates the mapping tables."""
         if hasattr(self, 'db'):
             return
             
-        self.db = sqlite3.connect(self.sqlite_filepath.absolute())
-        with sqlite_cursor(self.db) as cursor:
+        self.db = sqlite_connect(self.sqlite_filepath.absolute())
+        if has_schema(self.db, self.tablename, 'schema_version'):
+            self._migrate()
+            return
+        with sqlite_cursor(self.db, write=True) as cursor:
 
             # The vggish source.  Each item data is fed to VGGish and the embedding
             # that spans multiple segments is stored.  The item_id is an external
@@ -140,4 +451,42 @@ class Store:
             );
             """)
 
-    
+            # Schema versions of tables which need migrating.
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+            );
+            """)
+        self._migrate()
+
+    def _migrate(self):
+        '''
+        Bring the embedding table up to the current schema version.
+        '''
+        migrations = [
+            # 1: one embedding per item and a unique index to find it.
+            [f"""
+            DELETE FROM {self.tablename} WHERE id NOT IN
+            (SELECT MAX(id) FROM {self.tablename} GROUP BY item_id);
+            """,
+             f"""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_item_{self.tablename}
+            ON {self.tablename} (item_id);
+            """],
+        ]
+        if self._schema_version() >= len(migrations):
+            return
+        with self.writing(), sqlite_cursor(self.db, write=True) as cursor:
+            version = self._schema_version()
+            for number, statements in enumerate(migrations[version:], start=version + 1):
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute(
+                    "INSERT OR REPLACE INTO schema_version (name, version) VALUES (?, ?)",
+                    (self.tablename, number))
+
+    def _schema_version(self):
+        got = self.db.execute("SELECT version FROM schema_version WHERE name = ?",
+                              (self.tablename,)).fetchone()
+        return got[0] if got else 0
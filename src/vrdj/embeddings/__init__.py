@@ -1 +1,52 @@
-from . import vggish
+'''
+Embedding models.
+
+Each embedding is a module providing "vector_length" and a "Model" class.  The
+modules of this package are built in and other packages may add more by
+declaring "vrdj.embeddings" entry points, eg in their pyproject.toml:
+
+    [project.entry-points."vrdj.embeddings"]
+    mymodel = "mypackage.mymodel"
+
+Each embedding has its own table of stored embeddings and its own indices so
+many may be used side by side in one vrdj directory.
+
+These modules must stay cheap to import: heavy dependencies such as torch may
+only be imported once a Model actually computes an embedding.
+'''
+import importlib
+from importlib import metadata
+
+# The entry point group of embedding modules.
+group = 'vrdj.embeddings'
+
+# Names of the embedding modules of this package.
+builtin = ('vggish',)
+
+def entry_points():
+    '''
+    Return a dict of the embedding entry points by name.
+    '''
+    eps = metadata.entry_points()
+    if hasattr(eps, 'select'):
+        eps = eps.select(group=group)
+    else:
+        eps = eps.get(group, ())  # Python < 3.10
+    return {ep.name: ep for ep in eps}
+
+def names():
+    '''
+    Return the sorted names of all available embeddings.
+    '''
+    return sorted(set(builtin).union(entry_points()))
+
+def get(name):
+    '''
+    Return the embedding module of the given name.
+    '''
+    if name in builtin:
+        return importlib.import_module(f'{__name__}.{name}')
+    ep = entry_points().get(name)
+    if ep is None:
+        raise ValueError(f'unknown embedding "{name}", expect one of: {", ".join(names())}')
+    return ep.load()
@@ -0,0 +1,280 @@
+'''
+The vrdj audio front-end.
+
+This turns audio files into the log-mel examples VGGish expects.  It gives the
+same examples as torchvggish's vggish_input, to within 1e-5 in every log-mel
+value (see vrdj.bench.frontend), but:
+
+- decodes any format soundfile supports in blocks straight to mono,
+- resamples with a polyphase filter bank computed once per sample rate and
+  applied as a single matrix product per block instead of resampy's per-sample
+  loop (and so needs no numba),
+- frames, windows and mel-filters whole blocks of frames at once with the
+  window and mel matrix computed once.
+
+Only numpy and soundfile are needed.
+'''
+import math
+import importlib.util
+from functools import lru_cache
+from pathlib import Path
+import numpy
+from vrdj import trace
+
+# VGGish frames 16 kHz audio into 25 ms STFT windows every 10 ms and groups 96
+# frames into one example with no overlap.
+sample_rate = 16000
+stft_window = 400
+stft_hop = 160
+fft_length = 512
+num_frames = 96
+num_bands = 64
+mel_min_hz = 125.0
+mel_max_hz = 7500.0
+log_offset = 0.01
+example_hop = num_frames * stft_hop
+example_span = (num_frames - 1) * stft_hop + stft_window
+
+
+@lru_cache
+def load_filter(name='kaiser_best'):
+    '''
+    Return (half_window, table_size) of a resampy interpolation filter.
+
+    The filter table is read from the resampy package data without importing
+    resampy.  If resampy is not installed, an equivalent Kaiser windowed sinc
+    is computed from the published parameters.
+    '''
+    spec = importlib.util.find_spec('resampy')
+    if spec and spec.submodule_search_locations:
+        path = Path(list(spec.submodule_search_locations)[0]) / 'data' / f'{name}.npz'
+        if path.exists():
+            data = numpy.load(path)
+            return data['half_window'], int(data['precision'])
+
+    params = dict(kaiser_best=(12.9846, 0.917347, 50, 13),
+                  kaiser_fast=(9.90322, 0.868212, 24, 9))
+    beta, rolloff, num_zeros, precision = params[name]
+    table = 2**precision
+    n = table * num_zeros
+    sinc = rolloff * numpy.sinc(rolloff * numpy.linspace(0, num_zeros, n + 1))
+    return numpy.kaiser(2 * n + 1, beta)[n:] * sinc, table
+
+
+class Resampler:
+    '''
+    Resample audio between two fixed rates.
+
+    This computes what resampy.resample() does with the same filter, to
+    floating point rounding.  Output sample j falls at input time
+    j * rate_in / rate_out.  The filter taps repeat every L output samples,
+    where L is rate_out divided by the greatest common divisor of the rates.
+    Each block of L (or a multiple of L) outputs is therefore the product of a
+    window of input samples with one fixed matrix.
+    '''
+
+    def __init__(self, rate_in, rate_out=sample_rate, filter='kaiser_best'):
+        gcd = math.gcd(rate_in, rate_out)
+        self.rate_in = rate_in
+        self.rate_out = rate_out
+        self.up = rate_out // gcd
+        self.down = rate_in // gcd
+
+        win, table = load_filter(filter)
+        ratio = rate_out / rate_in
+        if ratio < 1:
+            win = ratio * win
+        delta = numpy.diff(win, append=win[-1])
+        scale = min(1.0, ratio)
+        step = int(scale * table)
+
+        def wing(frac):
+            index = frac * table
+            offset = int(index)
+            taps = numpy.arange((len(win) - offset) // step) * step + offset
+            return win[taps] + (index - offset) * delta[taps]
+
+        phases = list()
+        for phase in range(self.up):
+            start, rem = divmod(phase * self.down, self.up)
+            frac = scale * rem / self.up
+            left = wing(frac)
+            right = wing(scale - frac)
+            phases.append((start - numpy.arange(len(left)), left))
+            phases.append((start + 1 + numpy.arange(len(right)), right))
+        self.lo = min(int(pos.min()) for pos, _ in phases if len(pos))
+        self.hi = max(int(pos.max()) for pos, _ in phases if len(pos))
+        weights = numpy.zeros((self.hi - self.lo + 1, self.up))
+        for n, (pos, weight) in enumerate(phases):
+            numpy.add.at(weights[:, n // 2], pos - self.lo, weight)
+
+        # With few phases (eg 48 kHz to 16 kHz has one) the product would be
+        # a long thin one so several periods are computed per input window.
+        periods = -(-64 // self.up)
+        self.block_in = periods * self.down
+        self.block_out = periods * self.up
+        self.weights = numpy.zeros((len(weights) + self.block_in - self.down,
+                                    self.block_out))
+        for n in range(periods):
+            self.weights[n * self.down:n * self.down + len(weights),
+                         n * self.up:(n + 1) * self.up] = weights
+
+    @property
+    def context(self):
+        '''
+        Number of input samples to either side that an output depends on.
+        '''
+        return max(-self.lo, self.hi - self.down + 1)
+
+    def __call__(self, audio):
+        '''
+        Return the 1D audio resampled, treating samples beyond it as zero.
+        '''
+        nout = len(audio) * self.up // self.down
+        nblocks = -(-nout // self.block_out)
+        need = (nblocks - 1) * self.block_in + len(self.weights) + self.lo
+        padded = numpy.concatenate([numpy.zeros(-self.lo), audio,
+                                    numpy.zeros(max(0, need - len(audio)))])
+        windows = numpy.lib.stride_tricks.sliding_window_view(
+            padded, len(self.weights))[::self.block_in][:nblocks]
+        return (windows @ self.weights).ravel()[:nout]
+
+
+@lru_cache
+def resampler(rate_in, rate_out=sample_rate):
+    '''
+    Return a cached Resampler between the rates.
+    '''
+    return Resampler(rate_in, rate_out)
+
+
+@lru_cache
+def _hann():
+    # The "periodic" Hann window used by VGGish.
+    return 0.5 - 0.5 * numpy.cos(2 * numpy.pi / stft_window * numpy.arange(stft_window))
+
+
+@lru_cache
+def mel_matrix():
+    '''
+    Return the (fft_length // 2 + 1, num_bands) mel filterbank of VGGish.
+    '''
+    def mel(hertz):
+        return 1127.0 * numpy.log(1.0 + hertz / 700.0)
+    bins = mel(numpy.linspace(0.0, sample_rate / 2, fft_length // 2 + 1))
+    edges = numpy.linspace(mel(mel_min_hz), mel(mel_max_hz), num_bands + 2)
+    lower, center, upper = edges[:-2], edges[1:-1], edges[2:]
+    rising = (bins[:, None] - lower) / (center - lower)
+    falling = (upper - bins[:, None]) / (upper - center)
+    matrix = numpy.maximum(0.0, numpy.minimum(rising, falling))
+    matrix[0, :] = 0.0
+    return matrix
+
+
+def log_mel(audio):
+    '''
+    Return the (nframes, num_bands) log-mel spectrogram of 16 kHz audio.
+    '''
+    frames = numpy.lib.stride_tricks.sliding_window_view(audio, stft_window)[::stft_hop]
+    spectrum = numpy.abs(numpy.fft.rfft(frames * _hann(), fft_length))
+    return numpy.log(spectrum @ mel_matrix() + log_offset)
+
+
+def to_examples(audio):
+    '''
+    Return the complete examples of 16 kHz audio shaped (n, num_frames,
+    num_bands) and the number of samples they consume.
+    '''
+    if len(audio) < example_span:
+        return numpy.zeros((0, num_frames, num_bands)), 0
+    count = 1 + (len(audio) - example_span) // example_hop
+    mel = log_mel(audio[:(count - 1) * example_hop + example_span])
+    return mel.reshape(count, num_frames, num_bands), count * example_hop
+
+
+def decode(filepath, block_seconds=30, timer=None):
+    '''
+    Generate the mono audio of a file at the VGGish sample rate in blocks.
+
+    Blocks of about block_seconds are read and resampled with enough of their
+    neighbours that the result matches resampling the whole file at once.  If
+    given, timer(stage, seconds) is called with the time spent in the "decode"
+    and "resample" stages.
+    '''
+    import time
+    import soundfile
+
+    def timed(stage, func, *args):
+        if timer is None:
+            with trace.span(f'audio.{stage}'):
+                return func(*args)
+        start = time.perf_counter()
+        got = func(*args)
+        timer(stage, time.perf_counter() - start)
+        return got
+
+    with soundfile.SoundFile(filepath) as sf:
+        rate = sf.samplerate
+        # Block boundaries fall on input samples which map exactly onto
+        # output samples.
+        step = rate // math.gcd(rate, sample_rate)
+        block = step * max(1, round(block_seconds * rate / step))
+
+        def read():
+            data = sf.read(block, dtype='int16', always_2d=True)
+            return numpy.mean(data / 32768.0, axis=1)
+
+        if rate == sample_rate:
+            while len(data := timed('decode', read)):
+                yield data
+            return
+
+        resample = resampler(rate)
+        context = step * math.ceil(resample.context / step)
+        skip = context * sample_rate // rate
+        prev = numpy.zeros(context)
+        cur = timed('decode', read)
+        while len(cur):
+            nxt = timed('decode', read)
+            audio = numpy.concatenate([prev[-context:], cur, nxt[:context]])
+            out = timed('resample', resample, audio)
+            yield out[skip:skip + len(cur) * sample_rate // rate]
+            prev = numpy.concatenate([prev, cur])[-context:]
+            cur = nxt
+
+
+def stream_examples(filepath, batch_size=256, block_seconds=30, timer=None):
+    '''
+    Generate log-mel examples of an audio file in float32 arrays shaped
+    (n, 1, num_frames, num_bands) with n at most batch_size.
+
+    The timer is as for decode() and also receives the "logmel" stage.
+    '''
+    import time
+
+    buf = numpy.zeros(0)
+    pending = numpy.zeros((0, 1, num_frames, num_bands), dtype='float32')
+    for audio in decode(filepath, block_seconds, timer):
+        buf = numpy.concatenate([buf, audio])
+        start = time.perf_counter()
+        with trace.span('audio.logmel'):
+            got, used = to_examples(buf)
+        if timer:
+            timer('logmel', time.perf_counter() - start)
+        buf = buf[used:]
+        pending = numpy.concatenate([pending, got[:, None].astype('float32')])
+        while len(pending) >= batch_size:
+            yield pending[:batch_size]
+            pending = pending[batch_size:]
+    if len(pending):
+        yield pending
+
+
+def examples(filepath):
+    '''
+    Return all log-mel examples of an audio file shaped (n, 1, 96, 64).
+    '''
+    got = list(stream_examples(filepath))
+    if not got:
+        return numpy.zeros((0, 1, num_frames, num_bands), dtype='float32')
+    return numpy.concatenate(got)
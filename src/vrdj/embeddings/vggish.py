@@ -1,31 +1,160 @@
-import torch
-from torchvggish import vggish_input, vggish
+'''
+The VGGish embedding.
+
+torch and torchvggish are imported only when needed so that using stored
+embeddings does not pay their import cost.
+
+Audio is turned into log-mel examples by vrdj.embeddings.frontend in blocks so
+memory use does not grow with the length of the audio file.
+'''
+import numpy
+from vrdj import trace
+from vrdj.embeddings import frontend
 
 vector_length = 128
 
+def stream_examples(filepath, batch_size=256, block_seconds=30):
+    '''
+    Generate log-mel examples of an audio file in arrays shaped (n, 1, 96, 64)
+    with n at most batch_size.
+
+    The examples match those torchvggish makes from the whole file.
+    '''
+    return frontend.stream_examples(filepath, batch_size, block_seconds)
+
+def examples(filepath):
+    '''
+    Return the log-mel examples of an audio file shaped (nexamples, 1, 96, 64).
+
+    This decodes and extracts features but runs no model so it is cheap to
+    call from a worker process.
+    '''
+    return frontend.examples(filepath)
+
 class Model:
-    def __init__(self, device = 'cpu'):
-        torch.set_default_device(device)
-        self.device = torch.device(device)
+    '''
+    The VGGish network.
+
+    The compile option may be "torch" to use torch.compile() or "script" to
+    trace the network to TorchScript.  Compiled models are always given full
+    batches of max_examples so their input shape never changes.  The threads
+    option sets the number of CPU threads torch uses.
+
+    The stats count the examples embedded and the seconds spent doing so.
+    '''
+
+    # Maximum number of examples to push through the network at once.
+    max_examples = 256
+
+    def __init__(self, device = 'cpu', compile=None, threads=None, max_examples=None):
+        self._device = device
+        self._compile = compile
+        self._threads = threads
+        if max_examples:
+            self.max_examples = max_examples
+        self.stats = dict(examples=0, seconds=0.0)
+
+    @property
+    def rate(self):
+        '''
+        Examples embedded per second.
+        '''
+        seconds = self.stats['seconds']
+        return self.stats['examples'] / seconds if seconds > 0 else 0.0
+
+    @property
+    def device(self):
+        if not hasattr(self, '_torch_device'):
+            import torch
+            if self._threads:
+                torch.set_num_threads(self._threads)
+            torch.set_default_device(self._device)
+            self._torch_device = torch.device(self._device)
+        return self._torch_device
 
     @property
     def model(self):
         if not hasattr(self, '_model'):
-            model = vggish()
-            model.eval()
-            self._model = model.to(self.device)
+            with trace.span('model.load'):
+                self._model = self._make_model()
         return self._model
 
+    def _make_model(self):
+        import torch
+        from torchvggish import vggish
+        model = vggish()
+        model.eval()
+        model = model.to(self.device)
+        if self._compile == 'torch':
+            model = torch.compile(model)
+        elif self._compile == 'script':
+            example = torch.zeros((self.max_examples, 1, frontend.num_frames,
+                                   frontend.num_bands), device=self.device)
+            with torch.inference_mode():
+                model = torch.jit.freeze(torch.jit.trace(model, example,
+                                                         check_trace=False))
+        elif self._compile:
+            raise ValueError(f'unknown compile option: {self._compile}')
+        return model
+
+    def _forward(self, batch):
+        '''
+        Return the (n, vector_length) embeddings of an (n, 1, 96, 64) batch of
+        at most max_examples examples.
+        '''
+        import time
+        import torch
+        count = len(batch)
+        if self._compile and count < self.max_examples:
+            pad = numpy.zeros((self.max_examples - count,) + batch.shape[1:],
+                              dtype=batch.dtype)
+            batch = numpy.concatenate([batch, pad])
+        model = self.model
+        start = time.perf_counter()
+        with trace.span('model.forward', items=count), torch.inference_mode():
+            emb = model(torch.from_numpy(batch).to(self.device))
+            emb = emb.cpu().numpy().astype('float32').reshape(len(batch), -1)
+        self.stats['seconds'] += time.perf_counter() - start
+        self.stats['examples'] += count
+        return emb[:count]
+
     def waveform(self, filepath):
-        tensor = vggish_input.wavfile_to_examples(filepath)
-        return tensor.cpu().numpy().astype('float32')
+        return examples(filepath)
 
     def embedding(self, audio):
-        with torch.no_grad():
-            if isinstance(audio, str):
-                audio = vggish_input.wavfile_to_examples(audio)
+        import torch
+        if isinstance(audio, str):
+            with trace.span('model.embedding', items=1):
+                got = list(self.embedding_stream(audio))
+            if not got:
+                return numpy.zeros((0, vector_length), dtype='float32')
+            return numpy.vstack(got)
+        with torch.inference_mode():
             audio = audio.to(self.device)
             emb = self.model.forward(audio)
             return emb.cpu().numpy().astype('float32')
-    
-            
+
+    def embedding_stream(self, filepath, batch_size=None):
+        '''
+        Generate the embedding of an audio file as arrays of consecutive
+        segment vectors, each of at most batch_size (default max_examples).
+
+        Peak memory depends on batch_size and not on the length of the file.
+        '''
+        batch_size = min(batch_size or self.max_examples, self.max_examples)
+        for ex in stream_examples(filepath, batch_size):
+            yield self._forward(ex)
+
+    def embed_examples(self, many):
+        '''
+        Return a list of embeddings, one for each examples array in many.
+
+        The examples of all arrays are run through the model together in
+        batches of at most max_examples.
+        '''
+        counts = [len(ex) for ex in many]
+        batch = numpy.concatenate(many)
+        out = [self._forward(batch[start:start + self.max_examples])
+               for start in range(0, len(batch), self.max_examples)]
+        embs = numpy.vstack(out) if out else numpy.zeros((0, vector_length), dtype='float32')
+        return numpy.split(embs, numpy.cumsum(counts)[:-1])
@@ -0,0 +1,143 @@
+'''
+vrdj bulk ingest
+
+Ingesting one item at a time leaves most of the machine idle.  Bulk ingest
+instead runs a staged pipeline:
+
+1. Audio decode and log-mel feature extraction in a pool of worker processes.
+2. Batched model inference in this process.
+3. A single writer committing embeddings and vectors in bulk.
+
+Items are fed to the model in batches as soon as enough of them have been
+decoded so stage 1 keeps working while stages 2 and 3 run.
+'''
+
+import os
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+log = logging.getLogger(__name__)
+
+
+class IngestStats:
+    '''
+    Counters describing the progress of a bulk ingest.
+    '''
+    def __init__(self, total=0):
+        self.total = total
+        self.skipped = 0
+        self.failed = 0
+        self.done = 0
+        self.examples = 0
+        self.model_rate = 0.0
+        self.start = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    @property
+    def rate(self):
+        '''
+        Items ingested per second.
+        '''
+        elapsed = self.elapsed
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        handled = self.done + self.skipped + self.failed
+        return (f'{handled}/{self.total} items '
+                f'(done={self.done} skipped={self.skipped} failed={self.failed}) '
+                f'in {self.elapsed:.1f}s, {self.rate:.2f} items/s, '
+                f'{self.examples / max(self.elapsed, 1e-9):.1f} examples/s '
+                f'({self.model_rate:.1f} examples/s in the model)')
+
+
+def bulk_ingest(store, items, workers=None, batch_size=32, force=False,
+                checkpoint=1024, progress=None, groups=None):
+    '''
+    Ingest many items into the store.
+
+    The items are a sequence of (item_id, audio_path).  Items which already
+    have a stored embedding are skipped unless force is True.
+
+    The workers sets the number of decode processes and defaults to the number
+    of CPUs.  The batch_size sets how many items are run through the model and
+    committed together.  Vector indices are saved every checkpoint items and
+    when the ingest ends.  If given, progress is called with the IngestStats
+    after each batch is committed.  If given, groups maps item IDs to their
+    album, artist etc as for Scheme.add_groups().  Skipped items are then
+    added to any of their groups they are not yet in.
+
+    Return the final IngestStats.
+    '''
+    items = list(items)
+    stats = IngestStats(len(items))
+
+    if not force:
+        have = store.stored_item_ids([item_id for item_id, _ in items])
+        stats.skipped = sum(1 for item_id, _ in items if item_id in have)
+        items = [(item_id, path) for item_id, path in items if item_id not in have]
+        if groups:
+            # Stored items ingested without their groups are added to them.
+            store.add_groups({item_id: groups[item_id] for item_id in have
+                              if item_id in groups})
+    if not items:
+        return stats
+
+    workers = workers or os.cpu_count() or 1
+    batch_size = max(1, batch_size)
+    extract = store.embedding_module.examples
+
+    def commit(batch):
+        ids = [item_id for item_id, _ in batch]
+        embs = store.model.embed_examples([ex for _, ex in batch])
+        store.add_many_embeddings(zip(ids, embs), groups)
+        stats.done += len(batch)
+        stats.examples += sum(len(ex) for _, ex in batch)
+        stats.model_rate = getattr(store.model, 'rate', 0.0)
+        if progress:
+            progress(stats)
+
+    # Bound the number of decoded-but-not-embedded items held in memory.
+    window = workers + batch_size
+    todo = iter(items)
+    inflight = dict()
+    batch = list()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool, \
+         store.writing(), store.scheme.batch(checkpoint):
+
+        def submit():
+            while len(inflight) < window:
+                try:
+                    item_id, path = next(todo)
+                except StopIteration:
+                    return
+                inflight[pool.submit(extract, path)] = (item_id, path)
+
+        submit()
+        while inflight:
+            done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                item_id, path = inflight.pop(fut)
+                try:
+                    examples = fut.result()
+                except Exception as err:
+                    log.error(f'failed to decode {item_id} {path}: {err}')
+                    stats.failed += 1
+                    continue
+                if len(examples) == 0:
+                    log.error(f'no audio examples for {item_id} {path}')
+                    stats.failed += 1
+                    continue
+                batch.append((item_id, examples))
+            submit()
+            if len(batch) >= batch_size:
+                commit(batch)
+                batch = list()
+        if batch:
+            commit(batch)
+
+    return stats
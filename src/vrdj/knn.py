@@ -0,0 +1,196 @@
+'''
+vrdj k-nearest-neighbour graph
+
+For a library which changes slowly, the neighbours of every song may be found
+once in bulk so that "similar to this song" is answered by a lookup.
+
+The graph holds, for each vector of an index, the item IDs and scores of the k
+most similar other items ordered from most to least similar.  Rows are indexed
+by vector ID and the two arrays are saved as .npy files next to the index file
+and loaded memory-mapped.  Scores are oriented so larger is more similar.
+'''
+
+import os
+import numpy
+import faiss
+from pathlib import Path
+
+
+class KnnGraph:
+    '''
+    The k-nearest-neighbour graph of an Index with one vector per item.
+    '''
+
+    # Number of added vectors after which update() extends the graph.
+    update_batch = 1024
+
+    def __init__(self, index):
+        self.index = index
+        stem = index.filepath.with_suffix('')
+        self.items_path = Path(f'{stem}.knn-items.npy')
+        self.scores_path = Path(f'{stem}.knn-scores.npy')
+
+    @property
+    def exists(self):
+        return self.items_path.exists() and self.scores_path.exists()
+
+    @property
+    def k(self):
+        return self.items.shape[1]
+
+    @property
+    def items(self):
+        '''
+        The (nvectors, k) array of neighbour item IDs, -1 if none.
+        '''
+        if not hasattr(self, '_items'):
+            self._items = numpy.load(self.items_path, mmap_mode='r')
+            self._scores = numpy.load(self.scores_path, mmap_mode='r')
+        return self._items
+
+    @property
+    def scores(self):
+        '''
+        The (nvectors, k) array of neighbour scores.
+        '''
+        self.items
+        return self._scores
+
+    def neighbours(self, item_id, count, return_scores=False):
+        '''
+        Return up to count item IDs most similar to item_id.
+
+        Return None if the graph can not answer, ie it does not exist, does not
+        cover the item or holds fewer than count neighbours.  If return_scores
+        is True, return tuple of (item_ids, scores).
+        '''
+        if not self.exists or count > self.k:
+            return None
+        row = int(self.index.item_vector_ids([item_id])[0])
+        if row < 0 or row >= len(self.items):
+            return None
+        items = self.items[row, :count]
+        keep = items >= 0
+        found = items[keep].tolist()
+        if return_scores:
+            return found, self.scores[row, :count][keep].tolist()
+        return found
+
+    def _search(self, start, stop, k):
+        '''
+        Return neighbour (vector_ids, item_ids, scores) of vectors start to
+        stop, each shaped (stop - start, k), excluding a vector's own item.
+        '''
+        index = self.index
+        vids = numpy.arange(start, stop, dtype='int64')
+        found, scores = index.query_many(index.vectors(vids), k + 1,
+                                         return_scores=True)
+        items = index.resolve(found)
+        scores = index.similarity(scores)
+        own = index.resolve(vids)
+        valid = (items >= 0) & (items != own[:, None])
+        # Move valid hits to the front of each row, keeping their order.
+        order = numpy.argsort(~valid, axis=1, kind='stable')[:, :k]
+        valid = numpy.take_along_axis(valid, order, axis=1)
+        found = numpy.where(valid, numpy.take_along_axis(found, order, axis=1), -1)
+        items = numpy.where(valid, numpy.take_along_axis(items, order, axis=1), -1)
+        scores = numpy.where(valid, numpy.take_along_axis(scores, order, axis=1),
+                             -numpy.inf).astype('float32')
+        if items.shape[1] < k:
+            pad = k - items.shape[1]
+            found = numpy.pad(found, ((0, 0), (0, pad)), constant_values=-1)
+            items = numpy.pad(items, ((0, 0), (0, pad)), constant_values=-1)
+            scores = numpy.pad(scores, ((0, 0), (0, pad)), constant_values=-numpy.inf)
+        return found, items, scores
+
+    def build(self, k=50, block=4096, progress=None):
+        '''
+        Build the graph of all vectors of the index.
+
+        Vectors are searched against the index in blocks of block vectors.  If
+        given, progress is called with the number of vectors done.
+        '''
+        ntotal = self.index.index.ntotal
+        items = numpy.full((ntotal, k), -1, dtype='int64')
+        scores = numpy.full((ntotal, k), -numpy.inf, dtype='float32')
+        for start in range(0, ntotal, block):
+            stop = min(start + block, ntotal)
+            _, items[start:stop], scores[start:stop] = self._search(start, stop, k)
+            if progress:
+                progress(stop)
+        self._save(items, scores)
+
+    def update(self, force=False, block=65536):
+        '''
+        Extend the graph to vectors added to the index since it was saved.
+
+        New vectors get their own rows by searching the index.  Existing rows
+        are searched against only the new vectors, in blocks of block rows,
+        and just the rows where a new vector beats the k-th neighbour are
+        merged with their new candidates.
+
+        The graph files are rewritten whole, so unless force is True nothing
+        is done until at least update_batch vectors were added.  Until then
+        op.similar_average_item() searches the index for items not in the
+        graph and existing rows may lack the newest items.
+        '''
+        if not self.exists:
+            return
+        nrows, k = self.items.shape
+        index = self.index
+        ntotal = index.index.ntotal
+        if ntotal <= nrows or (ntotal - nrows < self.update_batch and not force):
+            return
+        _, new_items, new_scores = self._search(nrows, ntotal, k)
+
+        added = numpy.arange(nrows, ntotal, dtype='int64')
+        added_items = index.resolve(added)
+        sub = faiss.IndexFlat(index.index.d, index.index.metric_type)
+        sub.add(index.vectors(added))
+        nsub = min(k, len(added))
+
+        items = numpy.empty((ntotal, k), dtype='int64')
+        scores = numpy.empty((ntotal, k), dtype='float32')
+        items[:nrows] = self.items
+        scores[:nrows] = self.scores
+        items[nrows:] = new_items
+        scores[nrows:] = new_scores
+        for start in range(0, nrows, block):
+            stop = min(start + block, nrows)
+            vecs = index.vectors(numpy.arange(start, stop, dtype='int64'))
+            hits, got = sub.search(vecs, nsub)
+            hits = index.similarity(hits)
+            # Hits are ordered so only rows whose best beats their k-th change.
+            rows = numpy.flatnonzero(hits[:, 0] > scores[start:stop, k - 1])
+            if not len(rows):
+                continue
+            hits, got = hits[rows], got[rows]
+            rows += start
+            cand_items = numpy.hstack([items[rows], added_items[got]])
+            cand_scores = numpy.hstack([scores[rows], hits])
+            cand_scores[cand_items < 0] = -numpy.inf
+            order = numpy.argsort(-cand_scores, axis=1, kind='stable')[:, :k]
+            items[rows] = numpy.take_along_axis(cand_items, order, axis=1)
+            scores[rows] = numpy.take_along_axis(cand_scores, order, axis=1)
+        self._save(items, scores)
+
+    def remove(self):
+        '''
+        Remove the graph files.
+        '''
+        self._forget()
+        for path in (self.items_path, self.scores_path):
+            if path.exists():
+                path.unlink()
+
+    def _forget(self):
+        for attr in ('_items', '_scores'):
+            if hasattr(self, attr):
+                delattr(self, attr)
+
+    def _save(self, items, scores):
+        self._forget()
+        for path, arr in ((self.items_path, items), (self.scores_path, scores)):
+            tmppath = path.with_name(path.name + '.tmp.npy')
+            numpy.save(tmppath, arr)
+            os.replace(tmppath, path)
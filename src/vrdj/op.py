@@ -2,7 +2,13 @@
 vrdj operations
 '''
 
+import time
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from vrdj.knn import KnnGraph
+from vrdj import trace
 
 def ingest(store, item_path, item_id):
     '''
@@ -23,39 +29,525 @@ def ingest(store, item_path, item_id):
         store.flush()
         
         
+@trace.traced('op.similar_average_item')
 def similar_average_item(store, item_id, count):
     '''
-    Return item IDs for items similar to average vector of item_id.
+    Return IDs of the count items most similar to the average vector of
+    item_id, not including item_id.
+
+    This is answered from the k-nearest-neighbour graph (see "vrdj
+    knn-build") if it covers the item and falls back to searching the index.
     '''
+    found = store.scheme.knn.neighbours(item_id, count)
+    if found is not None:
+        return found
+
     emb = store.get_embedding(item_id)
+    if emb is None:
+        return []
 
     index = store.scheme.index_average
 
     vec = index.vectorize(emb)
-    vids, scores = index.query_one(vec, count, return_scores=True)
-    return index.get_items_by_vectors(vids)
+    vids, scores = index.query_one(vec, count + 1, return_scores=True)
+    found = [one for one in index.get_items_by_vectors(vids) if one != item_id]
+    return found[:count]
+
+def allowed_key(allowed):
+    '''
+    Return a short string identifying a set of allowed item IDs.
+    '''
+    ids = np.unique(np.asarray(list(allowed), dtype='int64'))
+    return hashlib.sha1(ids.tobytes()).hexdigest()
+
+def _rescale(values):
+    lo, hi = values.min(), values.max()
+    if hi <= lo:
+        return np.zeros_like(values)
+    return (values - lo) / (hi - lo)
+
+def mmr(query, vectors, count, diversity=0.5):
+    '''
+    Return indices of count of the (n, vector_length) candidate vectors
+    chosen by maximal marginal relevance to the query vector.
+
+    Each pick maximizes (1 - diversity) * relevance - diversity * redundancy.
+    Relevance is the cosine similarity to the query rescaled to [0, 1] over
+    the candidates.  Redundancy is the greatest cosine similarity to an
+    already picked candidate after subtracting the mean of the candidates,
+    which removes what all VGGish vectors share.  A diversity of zero keeps
+    the order of relevance.
 
-def similar_average_many(store, item_ids, count):
+    Each pick costs one matrix-vector product over the candidates.
+    '''
+    vectors = np.asarray(vectors, dtype='float32')
+    count = min(count, len(vectors))
+    if count == 0:
+        return np.zeros(0, dtype='int64')
+
+    def norms(vecs):
+        return np.maximum(np.sqrt(np.einsum('ij,ij->i', vecs, vecs)), 1e-12)
+
+    query = np.asarray(query, dtype='float32').ravel()
+    relevance = _rescale(vectors @ query / norms(vectors))
+    centered = vectors - vectors.sum(axis=0) / len(vectors)
+    scale = norms(centered)
+
+    picked = np.empty(count, dtype='int64')
+    gain = (1 - diversity) * relevance
+    redundancy = np.zeros(len(vectors), dtype='float32')
+    for n in range(count):
+        one = int(np.argmax(gain - diversity * redundancy))
+        picked[n] = one
+        sim = centered @ centered[one] / (scale * scale[one])
+        np.maximum(redundancy, sim, out=redundancy)
+        # Never pick the same candidate twice.
+        gain[one] = -np.inf
+    return picked
+
+@trace.traced('op.similar_average')
+def similar_average_many(store, item_ids, count, cache=True, allowed=None,
+                         diversity=0.0, fetch=None):
     '''
     Return item IDs for items similar to average vector of item_id.
+
+    If cache is True, the result is looked up in and saved to the store's
+    query cache whose store.cache.hits and store.cache.misses count the
+    outcome.
+
+    If allowed is given, only those item IDs are found.  The restriction is
+    applied inside the search so up to count allowed items are returned.
+
+    With a diversity greater than zero, fetch candidates (by default four
+    times count and at least 100) are found and count of them are chosen by
+    mmr() to avoid returning near duplicates.
+
+    A single seed without allowed or diversity is answered from the
+    k-nearest-neighbour graph, see similar_average_item(), if it covers the
+    seed.
     '''
     assert count > 0
 
+    item_ids = list(item_ids)
+    if len(item_ids) == 1 and allowed is None and not diversity > 0:
+        # The seed is its own best match, the graph holds the others.
+        found = store.scheme.knn.neighbours(item_ids[0], count - 1)
+        if found is not None:
+            return item_ids[:1] + found
+
     index = store.scheme.index_average
+    if diversity > 0:
+        fetch = max(fetch or max(4 * count, 100), count)
+
+    if cache:
+        params = dict(mode='average', count=count, index=index.filepath.name)
+        if allowed is not None:
+            params['allowed'] = allowed_key(allowed)
+        if diversity > 0:
+            params.update(diversity=diversity, fetch=fetch)
+        # A seed stored again, eg by a forced ingest, gives a new key.
+        params['seeds'] = store.embedding_stamps(item_ids)
+        key = store.cache.key(item_ids, **params)
+        version = index.version
+        got = store.cache.get(key, version)
+        if got is not None:
+            return got
 
     vectors = list()
-    for emb in store.get_many_embeddings(item_ids):
+    for emb in store.get_many_embeddings(item_ids).values():
         vec = index.vectorize(emb)
         # print(f'similar: {emb.shape=} {vec.shape=} {vec.dtype=}')
         vectors.append(vec)
+    if not vectors:
+        return []
     vecs = np.vstack(vectors)
     # print(f'similar: {vecs.shape=} {vecs.dtype=}')
     vec = np.mean(vecs, axis=0)
     # print(f'similar: {vec.shape=} {vec.dtype=} {count=}')
-    vids, scores = index.query_one(vec, count, return_scores=True)
+    want = fetch if diversity > 0 else count
+    if allowed is None:
+        vids = index.query_one(vec, want)
+    else:
+        vids = index.search(vec.reshape(1, -1), want, index.selector(allowed))[0][0]
+    # An IVF probing too few lists pads its result with -1.
+    vids = vids[vids >= 0]
+    if diversity > 0 and len(vids):
+        with trace.span('op.mmr', items=len(vids)):
+            vids = vids[mmr(vec, index.vectors(vids), count, diversity)]
     # for v,s in zip(vids, scores):
     #     print(f'vector_id={v} {type(v)} score={s}')
-    return index.get_items_by_vectors(vids)
+    found = index.get_items_by_vectors(vids)
+    if cache:
+        store.cache.put(key, version, found)
+    return found
+
+@trace.traced('op.similar_groups')
+def similar_groups(store, kind, names, count, cache=True, allowed=None):
+    '''
+    Return names of the groups of a kind, eg "album" or "artist", most
+    similar to the mean centroid of the named groups, not including them.
+
+    The cache is as for similar_average_many().  If given, only groups with
+    the allowed names are found.
+    '''
+    assert count > 0
+    index = store.scheme.centroids[kind]
+    names = [str(name) for name in names]
+
+    if cache:
+        params = dict(mode=kind, count=count, index=index.filepath.name)
+        if allowed is not None:
+            params['allowed'] = hashlib.sha1(
+                '\0'.join(sorted(set(map(str, allowed)))).encode()).hexdigest()
+        key = store.cache.key([], names=sorted(set(names)), **params)
+        version = index.version
+        got = store.cache.get(key, version)
+        if got is not None:
+            return got
+
+    vectors = index.group_vectors(names)
+    if not vectors:
+        return []
+    vec = np.mean(np.vstack(list(vectors.values())), axis=0).reshape(1, -1)
+    seeds = set(index.group_ids(names).values())
+    if allowed is None:
+        vids, _ = index.search(vec, count + len(seeds))
+    else:
+        group_ids = set(index.group_ids([str(one) for one in allowed]).values())
+        vids, _ = index.search(vec, count, index.selector(group_ids - seeds))
+    group_ids = [one for one in index.resolve(vids[0]).tolist()
+                 if one >= 0 and one not in seeds]
+    found = index.group_names(group_ids[:count])
+    if cache:
+        store.cache.put(key, version, found)
+    return found
+
+def radio(store, item_ids, window=50, artist_of=None, artist_gap=3,
+          drift=0.1, choices=5, temperature=0.05, fetch=None, seed=None,
+          allowed=None, refresh=4):
+    '''
+    Generate an endless stream of item IDs similar to the seed item_ids.
+
+    The stream is a random walk over the average index.  Each track is drawn
+    from the choices most similar allowed candidates to a centroid which
+    starts as the mean of the seed vectors.  Candidates are weighted by
+    exp(score / temperature) so a small temperature follows the best match.
+
+    - window :: no item is repeated within this many tracks.  Seeds count as
+      already played.
+    - artist_of :: if given, a callable returning the artist of an item ID.
+      No artist is repeated within artist_gap tracks while an alternative
+      exists.  It is called from this generator, not from a worker thread.
+    - drift :: after each track the centroid moves this fraction of the way
+      to that track's vector.  Zero keeps to the seeds.
+    - fetch :: how many candidates each search returns, by default enough to
+      survive the window.
+    - allowed :: if given, only these item IDs are played.
+    - refresh :: with drift, the candidates are searched again for the moved
+      centroid after this many tracks.
+
+    Tracks are drawn from the fetched candidates, rescored from their vectors
+    against the centroid before each pick, so most tracks need no search.  The
+    refresh search runs in a background thread and its candidates replace the
+    current ones once ready.  The thread only searches the FAISS index, the
+    candidates' item IDs and vectors are then got here from memory, so
+    yielding a track usually waits on no search or database query.
+    '''
+    index = store.scheme.index_average
+    seeds = [index.vectorize(emb)
+             for emb in store.get_many_embeddings(item_ids).values()]
+    if not seeds:
+        return
+    centroid = np.mean(np.vstack(seeds), axis=0)
+
+    # Load the index and its ID map here as the database connection may not
+    # be used from the search thread.
+    ntotal = index.index.ntotal
+    index.idmap
+    selector = None if allowed is None else index.selector(allowed)
+    if ntotal == 0:
+        return
+    fetch = min(fetch or window + 4 * choices + artist_gap, ntotal)
+    refresh = max(refresh, 1)
+
+    rng = np.random.default_rng(seed)
+    recent = deque(item_ids, maxlen=window)
+    artists = deque(maxlen=max(artist_gap, 0))
+
+    def search(vec, count):
+        vids, _ = index.search(vec.reshape(1, -1), count, selector)
+        return vids[0][vids[0] >= 0]
+
+    def candidates(vids):
+        # Vectors are got here rather than in the search thread as they may
+        # need the index to make a direct map.
+        return index.resolve(vids), index.vectors(vids)
+
+    def pick(items, scores):
+        played = set(recent)
+        allowed = np.array([one >= 0 and one not in played for one in items.tolist()])
+        if artist_of and artists:
+            spaced = allowed.copy()
+            for i in np.flatnonzero(allowed):
+                spaced[i] = artist_of(int(items[i])) not in artists
+            if spaced.any():
+                allowed = spaced
+        which = np.flatnonzero(allowed)
+        which = which[np.argsort(-scores[which], kind='stable')[:choices]]
+        if len(which) == 0:
+            return None
+        weights = np.exp((scores[which] - scores[which].max()) / max(temperature, 1e-9))
+        return rng.choice(which, p=weights / weights.sum())
 
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        items, vectors = candidates(search(centroid, fetch))
+        pending = None
+        since = 0
+        while True:
+            if pending is not None and pending.done():
+                items, vectors = candidates(pending.result())
+                pending = None
+            # Scored against the centroid as it is now, which may have moved
+            # since the candidates were searched.
+            scores = index.score(vectors, centroid)
+            chosen = pick(items, scores)
+            if chosen is None and pending is not None:
+                # The candidates are used up, wait on the refresh.
+                items, vectors = candidates(pending.result())
+                pending = None
+                continue
+            if chosen is None and fetch < ntotal:
+                # Everything near is recently played, look further out.
+                fetch = min(2 * fetch, ntotal)
+                items, vectors = candidates(search(centroid, fetch))
+                continue
+            if chosen is None:
+                # The whole index is within the window so replay the track
+                # played longest ago.
+                item_id = recent[0]
+                chosen = int(np.flatnonzero(items == item_id)[0]) \
+                    if item_id in items else None
+            if chosen is None:
+                return
+            item_id = int(items[chosen])
+            if drift:
+                centroid = (1 - drift) * centroid + drift * vectors[chosen]
+                since += 1
+                if since >= refresh and pending is None:
+                    pending = pool.submit(search, centroid, fetch)
+                    since = 0
+            recent.append(item_id)
+            if artist_of and artists.maxlen:
+                artists.append(artist_of(item_id))
+            yield item_id
 
 
+def aggregate_hits(item_ids, scores, method='max', topk=3):
+    '''
+    Aggregate per-query hits into one score per item.
+
+    The item_ids and scores are (nquery, k) arrays with larger scores being
+    more similar and an item_id of -1 marking a missing hit.  Each item first
+    keeps only its best hit per query.  These are then combined across queries
+    by method:
+
+    - max :: the best score of the item.
+    - mean :: the mean of the item's topk best scores.
+    - vote :: the number of queries hitting the item, ties broken by max.
+
+    Return (item_ids, scores) as 1D arrays ordered from most to least similar.
+    '''
+    nquery, k = item_ids.shape
+    rows = np.repeat(np.arange(nquery), k)
+    items = item_ids.ravel()
+    hits = scores.ravel()
+    keep = items >= 0
+    rows, items, hits = rows[keep], items[keep], hits[keep]
+
+    # Best hit per (query, item) pair.
+    order = np.lexsort((-hits, items, rows))
+    rows, items, hits = rows[order], items[order], hits[order]
+    first = np.ones(len(items), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (items[1:] != items[:-1])
+    items, hits = items[first], hits[first]
+
+    uniq, inv = np.unique(items, return_inverse=True)
+    best = np.full(len(uniq), -np.inf)
+    np.maximum.at(best, inv, hits)
+
+    if method == 'max':
+        order = np.argsort(-best, kind='stable')
+        return uniq[order], best[order]
+
+    if method == 'vote':
+        votes = np.bincount(inv, minlength=len(uniq)).astype('float64')
+        order = np.lexsort((-best, -votes))
+        return uniq[order], votes[order]
+
+    if method == 'mean':
+        order = np.lexsort((-hits, inv))
+        inv, hits = inv[order], hits[order]
+        starts = np.searchsorted(inv, np.arange(len(uniq)))
+        rank = np.arange(len(inv)) - starts[inv]
+        top = rank < topk
+        total = np.bincount(inv[top], weights=hits[top], minlength=len(uniq))
+        mean = total / np.bincount(inv[top], minlength=len(uniq))
+        order = np.argsort(-mean, kind='stable')
+        return uniq[order], mean[order]
+
+    raise ValueError(f'unsupported aggregate method: {method}')
+
+
+@trace.traced('op.similar_segment')
+def similar_segment_many(store, item_ids, count, aggregate='max', topk=3,
+                         hits=None, return_scores=False, cache=True,
+                         allowed=None):
+    '''
+    Return item IDs for items with segments similar to segments of item_ids.
+
+    Every segment of every seed is searched against the segment index in a
+    single query.  The hits number of nearest segments found for each seed
+    segment are reduced to one score per item with aggregate_hits().
+
+    If return_scores is True, return tuple of (item_ids, scores).  The cache
+    is as for similar_average_many().
+
+    If allowed is given, only those item IDs are found.  The segment index
+    is then searched with a selector of their vectors.
+    '''
+    assert count > 0
+
+    index = store.scheme.index_segment
+
+    if hits is None:
+        hits = max(100, 4 * count)
+
+    if cache:
+        params = dict(mode='segment', count=count, aggregate=aggregate,
+                      topk=topk, hits=hits, index=index.filepath.name)
+        if allowed is not None:
+            params['allowed'] = allowed_key(allowed)
+        # A seed stored again, eg by a forced ingest, gives a new key.
+        params['seeds'] = store.embedding_stamps(item_ids)
+        key = store.cache.key(item_ids, **params)
+        version = index.version
+        got = store.cache.get(key, version)
+        if got is not None:
+            return tuple(got) if return_scores else got[0]
+
+    vectors = [index.vectorize(emb)
+               for emb in store.get_many_embeddings(item_ids).values()]
+    if not vectors:
+        return ([], []) if return_scores else []
+    vecs = np.vstack(vectors)
+
+    selector = None if allowed is None else index.selector(allowed)
+    vids, scores = index.search(vecs, hits, selector)
+    found, agg = aggregate_hits(index.resolve(vids), index.similarity(scores),
+                                method=aggregate, topk=topk)
+    found = found[:count].tolist()
+    agg = agg[:count].tolist()
+    if cache:
+        store.cache.put(key, version, [found, agg])
+    if return_scores:
+        return found, agg
+    return found
+
+def rebuild_index(store, index, train_size=100000, seed=0, progress=None,
+                  chunk_size=1000):
+    '''
+    Rebuild an index of the store's scheme from all stored embeddings.
+
+    If the index type or its reduction requires training, it is first trained
+    on up to train_size vectors sampled evenly over the stored items.  The
+    embeddings are then read and vectorized chunk_size items at a time into a
+    new index in memory.  Finally the index file and its vector ID mapping are
+    replaced, see Index.flush().  If given, progress is called with the number
+    of items added so far.
+
+    Return the number of items indexed.
+    '''
+    nitems = store.count_embeddings()
+    if nitems == 0:
+        return 0
+
+    fresh = index.make_index()
+    if not fresh.is_trained:
+        rng = np.random.default_rng(seed)
+        per_item = max(1, train_size // nitems)
+        sample = list()
+        for _, emb in store.iter_embeddings():
+            vecs = index.vectorize(emb, reduce=False)
+            if len(vecs) > per_item:
+                vecs = vecs[rng.choice(len(vecs), per_item, replace=False)]
+            sample.append(vecs)
+        sample = np.vstack(sample)
+        if len(sample) > train_size:
+            sample = sample[rng.choice(len(sample), train_size, replace=False)]
+        # An IVF needs some dozens of training vectors per list.
+        nlist = index.index_options['nlist']
+        if len(sample) < 39 * nlist:
+            nlist = max(1, len(sample) // 39)
+            fresh = index.make_index(nlist=nlist)
+        fresh.train(sample)
+
+    index.reset(fresh)
+    done = 0
+    saved = index.checkpoint
+    index.checkpoint = 0
+    try:
+        batch = list()
+        for pair in store.iter_embeddings(chunk_size):
+            batch.append(pair)
+            if len(batch) == chunk_size:
+                index.add_embeddings(batch)
+                done += len(batch)
+                batch = list()
+                if progress:
+                    progress(done)
+        if batch:
+            index.add_embeddings(batch)
+            done += len(batch)
+            if progress:
+                progress(done)
+    finally:
+        index.checkpoint = saved
+    index.flush()
+
+    graph = KnnGraph(index)
+    if graph.exists:
+        graph.build(k=graph.k)
+    return done
+
+
+def compare_indices(test, baseline, queries, count=10):
+    '''
+    Compare search of a test index against a baseline index.
+
+    Both indices are searched with each of the (nqueries, vector_length)
+    queries, reduced as each index reduces its vectors.  Result vectors are
+    compared by their item IDs so the two indices need not number their
+    vectors identically.
+
+    Return a dict with the mean recall@count of test relative to baseline and
+    the mean per-query latency in milliseconds of each.
+    '''
+    def run(index):
+        # Warm up, eg an mmap or lazy load.
+        index.query_one(index.transform(queries[:1])[0], count)
+        start = time.perf_counter()
+        vids = index.query_many(index.transform(queries), count)
+        elapsed = time.perf_counter() - start
+        return index.resolve(vids), 1000 * elapsed / len(queries)
+
+    got, test_ms = run(test)
+    want, baseline_ms = run(baseline)
+    recalls = list()
+    for row_got, row_want in zip(got, want):
+        row_want = set(row_want[row_want >= 0].tolist())
+        if not row_want:
+            continue
+        recalls.append(len(row_want.intersection(row_got.tolist())) / len(row_want))
+    return dict(recall=float(np.mean(recalls)) if recalls else 0.0,
+                test_ms=test_ms, baseline_ms=baseline_ms,
+                nqueries=len(queries), count=count)
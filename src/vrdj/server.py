@@ -0,0 +1,127 @@
+'''
+vrdj query server
+
+A long-running process which opens a store once and answers similarity
+queries from many clients over a Unix socket, see vrdj.client for the
+protocol.  Requests are answered one at a time.
+
+Each query is one FAISS search in the server.  FAISS spreads a search of many
+vectors, eg the segments of the seeds, over threads, by default one per core.
+The memory-mapped index files are held once in the page cache.
+
+Indices replaced on disk by an ingest in another process are reloaded before
+the next query.
+'''
+
+import os
+import logging
+import socketserver
+from pathlib import Path
+
+import faiss
+
+from vrdj.client import Client, send_message, recv_message
+
+log = logging.getLogger(__name__)
+
+
+def default_socket(dirpath):
+    '''
+    Return the default socket path for the store at dirpath.
+    '''
+    return Path(dirpath) / 'vrdj.sock'
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        request = recv_message(self.request)
+        if request is None:
+            return
+        try:
+            reply = dict(ok=True, result=self.server.vrdj.handle(request))
+        except Exception as err:
+            log.exception(f'failed request {request}')
+            reply = dict(ok=False, error=f'{type(err).__name__}: {err}')
+        send_message(self.request, reply)
+
+
+class Server:
+    '''
+    Answer queries of the store on a Unix socket path.
+
+    With threads greater than zero, FAISS searches with that many threads.
+    '''
+
+    def __init__(self, store, path=None, threads=0):
+        self.store = store
+        self.path = Path(path or default_socket(store.dirpath))
+        if self.path.exists():
+            if Client(self.path, timeout=1).ping() is not None:
+                raise RuntimeError(f'a vrdj server already listens on {self.path}')
+            self.path.unlink()
+        if threads:
+            faiss.omp_set_num_threads(threads)
+        # Load indices now rather than on the first query.
+        for index in store.scheme.all_indices.values():
+            index.index
+            index.idmap
+
+    def handle(self, request):
+        '''
+        Return the result of a request dict.
+        '''
+        from vrdj.op import similar_average_many, similar_segment_many, similar_groups
+        op = request.get('op')
+        store = self.store
+        if op == 'ping':
+            return dict(pid=os.getpid(), threads=faiss.omp_get_max_threads())
+        store.scheme.refresh()
+        if op == 'stats':
+            return dict(cache=store.cache.stats(),
+                        threads=faiss.omp_get_max_threads(),
+                        vectors={name: index.index.ntotal
+                                 for name, index in store.scheme.all_indices.items()})
+        if op == 'stored':
+            item_ids = [int(one) for one in request['item_ids']]
+            return dict(item_ids=sorted(store.stored_item_ids(item_ids)))
+        if op == 'similar':
+            item_ids = [int(one) for one in request['item_ids']]
+            count = int(request.get('count', 10))
+            cache = bool(request.get('cache', True))
+            allowed = request.get('allowed')
+            if request.get('mode', 'average') == 'segment':
+                found, scores = similar_segment_many(
+                    store, item_ids, count,
+                    aggregate=request.get('aggregate', 'max'),
+                    return_scores=True, cache=cache, allowed=allowed)
+                return dict(item_ids=found, scores=scores)
+            return dict(item_ids=similar_average_many(
+                store, item_ids, count, cache=cache, allowed=allowed,
+                diversity=float(request.get('diversity', 0.0))))
+        if op == 'similar_groups':
+            names = similar_groups(store, request['kind'], request['names'],
+                                   int(request.get('count', 10)),
+                                   cache=bool(request.get('cache', True)),
+                                   allowed=request.get('allowed'))
+            return dict(names=names)
+        raise ValueError(f'unknown request op: {op}')
+
+    def serve_forever(self):
+        '''
+        Answer requests until interrupted.
+        '''
+        server = socketserver.UnixStreamServer(str(self.path), _Handler)
+        server.vrdj = self
+        log.info(f'serving {self.store.dirpath} on {self.path}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.close()
+
+    def close(self):
+        if self.path.exists():
+            self.path.unlink()
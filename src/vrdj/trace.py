@@ -0,0 +1,153 @@
+'''
+vrdj tracing
+
+Time spans of the hot paths and summarize them by stage.  A span records its
+wall time and, if known, a count of items and of bytes handled:
+
+    from vrdj import trace
+    with trace.span('segment.search', items=len(vectors)):
+        ...
+
+Tracing is off unless enable() is called.  Then span() returns a shared
+do-nothing object so the cost to a traced path is one function call.
+
+When on, spans are summed per stage name and report() formats the totals as
+a table while export() writes them as JSON.
+'''
+
+import json
+import time
+import functools
+
+enabled = False
+_stages = dict()
+_start = time.perf_counter()
+
+
+class _Nothing:
+    '''
+    Stand-in for a Span while tracing is off.
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, items=0, nbytes=0):
+        pass
+
+
+_nothing = _Nothing()
+
+
+class Span:
+    '''
+    Time one stage.
+    '''
+    __slots__ = ('name', 'items', 'nbytes', 'start')
+
+    def __init__(self, name, items=0, nbytes=0):
+        self.name = name
+        self.items = items
+        self.nbytes = nbytes
+
+    def add(self, items=0, nbytes=0):
+        '''
+        Count more items or bytes handled by this span.
+        '''
+        self.items += items
+        self.nbytes += nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        stage = _stages.get(self.name)
+        if stage is None:
+            stage = _stages[self.name] = dict(calls=0, seconds=0.0, items=0, bytes=0)
+        stage['calls'] += 1
+        stage['seconds'] += seconds
+        stage['items'] += self.items
+        stage['bytes'] += self.nbytes
+        return False
+
+
+def span(name, items=0, nbytes=0):
+    '''
+    Return a context manager timing the named stage.
+    '''
+    if not enabled:
+        return _nothing
+    return Span(name, items, nbytes)
+
+
+def traced(name):
+    '''
+    Decorate a function so each call is a span of the named stage.
+    '''
+    def wrap(func):
+        @functools.wraps(func)
+        def call(*args, **kwds):
+            if not enabled:
+                return func(*args, **kwds)
+            with Span(name, items=1):
+                return func(*args, **kwds)
+        return call
+    return wrap
+
+
+def enable():
+    '''
+    Turn tracing on and forget previous spans.
+    '''
+    global enabled
+    enabled = True
+    reset()
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    global _start
+    _stages.clear()
+    _start = time.perf_counter()
+
+
+def stats():
+    '''
+    Return a dict of the totals of each stage and the wall time since
+    tracing was enabled.
+    '''
+    return dict(wall_seconds=time.perf_counter() - _start,
+                stages={name: dict(stage) for name, stage in sorted(_stages.items())})
+
+
+def report():
+    '''
+    Return a text table of the stages, slowest first.
+    '''
+    got = stats()
+    lines = [f'{"stage":<24} {"calls":>8} {"seconds":>10} {"ms/call":>9} '
+             f'{"items":>10} {"bytes":>12}']
+    stages = sorted(got['stages'].items(), key=lambda kv: -kv[1]['seconds'])
+    for name, stage in stages:
+        per = 1000 * stage['seconds'] / stage['calls']
+        lines.append(f'{name:<24} {stage["calls"]:>8} {stage["seconds"]:>10.4f} '
+                     f'{per:>9.3f} {stage["items"]:>10} {stage["bytes"]:>12}')
+    lines.append(f'wall time {got["wall_seconds"]:.3f}s')
+    return '\n'.join(lines)
+
+
+def export(path):
+    '''
+    Write the stats() as JSON to the file path.
+    '''
+    with open(path, 'w') as out:
+        json.dump(stats(), out, indent=2)
+        out.write('\n')
@@ -1,17 +1,141 @@
+import os
+import fcntl
+import sqlite3
+import logging
 from contextlib import contextmanager
 
+log = logging.getLogger(__name__)
+
+# Pragmas of every store connection.  WAL lets readers proceed while one
+# writer commits and NORMAL synchronous is durable at each checkpoint of the
+# WAL, which is safe for WAL mode.
+pragmas = dict(journal_mode='WAL', synchronous='NORMAL', temp_store='MEMORY',
+               cache_size=-65536, mmap_size=1 << 28)
+
+def sqlite_connect(path, timeout=30.0):
+    '''
+    Return a connection to the sqlite file at path set up for concurrent use.
+
+    The connection is in autocommit mode so transactions are only those made
+    explicit by transaction() or sqlite_cursor().  A locked database is
+    waited on for up to timeout seconds.
+    '''
+    connection = sqlite3.connect(str(path), timeout=timeout, isolation_level=None)
+    for name, value in pragmas.items():
+        connection.execute(f"PRAGMA {name} = {value}")
+    return connection
+
 @contextmanager
-def sqlite_cursor(connection):
+def transaction(connection, write=False):
+    """
+    A context manager for one transaction which is committed on normal exit
+    and rolled back on an exception.
+
+    A write transaction takes the database write lock at the start rather
+    than when it first writes, so it waits for another writer instead of
+    failing on a snapshot which that writer made stale.  Inside an already
+    open transaction this simply joins it.
+    """
+    if connection.in_transaction:
+        yield connection
+        return
+    connection.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+    try:
+        yield connection
+    except BaseException:
+        connection.rollback()
+        raise
+    connection.commit()
+
+@contextmanager
+def sqlite_cursor(connection, write=False):
     """
     A context manager for an sqlite3.Cursor object.
     It automatically creates a cursor upon entering the 'with' block
-    and closes it upon exiting.
+    and closes it upon exiting.  The block is one transaction, see
+    transaction().
     """
-    cursor = None
-    try:
+    with transaction(connection, write):
         cursor = connection.cursor()
-        yield cursor
-    finally:
-        if cursor:
+        try:
+            yield cursor
+        finally:
             cursor.close()
-            connection.commit()
+
+def has_schema(connection, *names):
+    '''
+    Return True if the tables and indices of all names exist.
+
+    This only reads so it lets an open skip the write transaction of creating
+    a schema which is already there.
+    '''
+    marks = ','.join('?' * len(names))
+    got = connection.execute(
+        f"SELECT COUNT(*) FROM sqlite_master WHERE name IN ({marks})",
+        names).fetchone()[0]
+    return got == len(set(names))
+
+class WriteLock:
+    '''
+    An advisory lock on a file held by at most one process at a time.
+
+    The store takes this lock while it changes its sqlite file or index files
+    so there is a single writer across processes.  Readers do not take it.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    @property
+    def held(self):
+        return self._fd is not None
+
+    def acquire(self, wait=True):
+        '''
+        Take the lock, waiting for another process to release it.
+
+        Return False if this object already holds the lock, else True.  If
+        wait is False, raise BlockingIOError rather than wait.
+        '''
+        if self._fd is not None:
+            return False
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if not wait:
+                    raise
+                log.info(f'waiting for the writer lock {self.path}')
+                fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+def chunked(seq, size):
+    '''
+    Yield successive lists of at most size elements from seq.
+    '''
+    seq = list(seq)
+    for start in range(0, len(seq), size):
+        yield seq[start:start + size]
+
+def fsync_path(path):
+    '''
+    Flush a written file to stable storage.
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)